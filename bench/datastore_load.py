@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Data store load time and memory, for each snapshot format.
+
+Writes a store of --keys account records, then loads it in a fresh process
+per format and reports load time, resident memory once loaded, peak resident
+memory, and the time and memory of writing a snapshot afterwards.
+  json         a json snapshot
+  binary       a binary snapshot, read with buffered reads
+  binary-mmap  a binary snapshot, read through mmap (data: mmap: true)
+
+mammon.data imports mammon.server, so this needs everything the server
+needs: ircreactor, and Python 3.6 or older, as mammon still uses
+asyncio.async.
+
+usage: python3 bench/datastore_load.py [--keys 100000]"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mammon.server
+from mammon.data import DataStore, convert_snapshot
+
+def rss_mb():
+    """Current resident memory, where /proc has it."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1048576.0
+    except (IOError, OSError):
+        return float('nan')
+
+def peak_rss_mb():
+    # VmHWM starts again at exec, ru_maxrss keeps the peak of the process that forked us
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on os x
+    return peak / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+class BenchLoop:
+    def call_later(self, *args):
+        pass
+
+def bench_context(data_conf):
+    return types.SimpleNamespace(
+        conf=types.SimpleNamespace(data=data_conf),
+        logger=logging.getLogger(''),
+        eventloop=BenchLoop(),
+    )
+
+def account(i):
+    return {
+        'passphrase': '$6$rounds=100000$' + base64.b64encode(os.urandom(12)).decode('ascii') + '$' + base64.b64encode(os.urandom(64)).decode('ascii'),
+        'scram-sha-256': {
+            'salt': base64.b64encode(os.urandom(16)).decode('ascii'),
+            'iterations': 4096,
+            'stored_key': base64.b64encode(os.urandom(32)).decode('ascii'),
+            'server_key': base64.b64encode(os.urandom(32)).decode('ascii'),
+        },
+        'registered_ts': 1440000000 + i,
+        'verified': True,
+        'callback': 'mailto:user{}@example.com'.format(i),
+    }
+
+def create(directory, keys):
+    filename = os.path.join(directory, 'store.json')
+    mammon.server.running_context = bench_context({
+        'format': 'json',
+        'filename': filename,
+        'save_frequency': {'minutes': 5},
+    })
+    store = DataStore()
+    store.create_or_load()
+    for i in range(keys):
+        store.put('account.user{}'.format(i), account(i))
+    store.save()
+
+    convert_snapshot(filename, os.path.join(directory, 'store.bin'))
+    return filename
+
+def child(mode, directory):
+    filename = os.path.join(directory, 'store.bin' if mode.startswith('binary') else 'store.json')
+    mammon.server.running_context = bench_context({
+        'format': 'json',
+        'filename': filename,
+        'save_frequency': {'minutes': 5},
+        'snapshot_format': 'binary' if mode.startswith('binary') else 'json',
+        'mmap': mode == 'binary-mmap',
+    })
+
+    before = rss_mb()
+    started = time.perf_counter()
+    store = DataStore()
+    store.create_or_load()
+    load_time = time.perf_counter() - started
+    loaded = rss_mb()
+    load_peak = peak_rss_mb()
+
+    # one changed key, then a full snapshot
+    store.put('account.user0', account(0))
+    started = time.perf_counter()
+    store.snapshot().result()
+    snapshot_time = time.perf_counter() - started
+
+    print(json.dumps({
+        'keys': len(store.list_keys()),
+        'load_time': load_time,
+        'rss_before': before,
+        'rss_loaded': loaded,
+        'load_peak': load_peak,
+        'snapshot_time': snapshot_time,
+        'rss_after_snapshot': rss_mb(),
+        'peak': peak_rss_mb(),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure data store load time and memory.')
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--modes', default='json,binary,binary-mmap')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = create(directory, args.keys)
+        print('{} keys, json snapshot {:.1f} MB, binary {:.1f} MB'.format(
+            args.keys, os.path.getsize(filename) / 1048576.0,
+            os.path.getsize(os.path.join(directory, 'store.bin')) / 1048576.0))
+        print('{:<12} {:>8} {:>12} {:>10} {:>10} {:>14}'.format(
+            'format', 'load', 'store RSS', 'load peak', 'snapshot', 'RSS after'))
+
+        for mode in args.modes.split(','):
+            # a fresh interpreter each time, so memory is measured from scratch
+            output = subprocess.check_output([sys.executable] + sys.argv[:1] + ['--child', mode, directory])
+            result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            print('{:<12} {:>7.2f}s {:>9.1f} MB {:>7.1f} MB {:>9.2f}s {:>11.1f} MB'.format(
+                mode, result['load_time'], result['rss_loaded'] - result['rss_before'],
+                result['load_peak'], result['snapshot_time'], result['rss_after_snapshot'] - result['rss_before']))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
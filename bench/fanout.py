@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Channel fan-out: PRIVMSGs per second to channels of 10 to 10k members.
+
+Members are ClientProtocol objects on a transport that only counts what it's
+given, with a mix of account-tag and server-time enabled.  Modes:
+  per-client  every member renders the message itself, as before fan-out
+              shared rendering
+  channel     Channel.dump_message, rendering once per message variant
+Each message is followed by one event loop iteration, so the sendq flushes
+are counted too.
+
+This drives the real ClientProtocol and Channel, so it needs everything the
+server needs: ircreactor, and Python 3.6 or older, as mammon still uses
+asyncio.async.
+
+usage: python3 bench/fanout.py [--sizes 10,100,1000,10000] [--duration 1]"""
+
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ircreactor.envelope import RFC1459Message
+
+import mammon.server
+from mammon.channel import Channel
+from mammon.client import ClientProtocol
+from mammon.clock import Clock
+from mammon.utility import CaseInsensitiveDict
+
+# registers server-time as a capability that changes how messages render
+import mammon.ext.ircv3.server_time
+
+# one in four members for each combination
+cap_mixes = ((), ('account-tag',), ('server-time',), ('account-tag', 'server-time'))
+
+class BenchTransport:
+    def __init__(self):
+        self.writes = 0
+        self.written = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+def bench_context(loop):
+    return types.SimpleNamespace(
+        conf=types.SimpleNamespace(name='bench.example.com', limits={'line': 512}),
+        logger=logging.getLogger(''),
+        eventloop=loop,
+        clock=Clock(),
+        roles=dict(),
+        sendq_flush_threshold=16384,
+        sendq_limit=1048576,
+    )
+
+def make_client(ctx, i):
+    """A registered client with the parts of connection_made that sending uses."""
+    cli = ClientProtocol()
+    cli.ctx = ctx
+    cli.transport = BenchTransport()
+    cli.sendq = list()
+    cli.sendq_len = 0
+    cli.sendq_flush_pending = False
+    cli.sendq_exceeded = False
+    cli.lines_sent = 0
+    cli.writing_paused = False
+    cli.channels = collections.OrderedDict()
+    cli.nickname = 'user{}'.format(i)
+    cli.username = 'u{}'.format(i)
+    cli.hostname = 'host{}.example.com'.format(i)
+    cli.realaddr = '127.0.0.1'
+    cli.account = 'account{}'.format(i) if i % 2 else None
+    cli.props = CaseInsensitiveDict()
+    cli.caps = CaseInsensitiveDict()
+    for cap in cap_mixes[i % len(cap_mixes)]:
+        cli.caps[cap] = True
+    cli.servername = ctx.conf.name
+    cli._role_name = None
+    cli.connected = True
+    cli.registered = True
+    return cli
+
+def run(loop, ctx, mode, size, duration):
+    channel = Channel('#bench')
+    members = [make_client(ctx, i) for i in range(size)]
+    for cli in members:
+        channel.join(cli)
+    source = members[0]
+
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        msg = RFC1459Message.from_data('PRIVMSG', source=source, params=[channel.name, 'hello world, message {}'.format(count)])
+        if mode == 'channel':
+            channel.dump_message(msg, exclusion_list=[source])
+        else:
+            for cli in channel.members:
+                if cli is not source:
+                    cli.dump_message(msg)
+        # let the sendqs flush
+        loop.run_until_complete(asyncio.sleep(0))
+        count += 1
+    elapsed = time.perf_counter() - started
+
+    writes = sum(cli.transport.writes for cli in members)
+    print('{:<11} {:>6} members {:>10.1f} msgs/s {:>12.0f} deliveries/s {:>8.1f} writes/msg'.format(
+        mode, size, count / elapsed, count * (size - 1) / elapsed, writes / count))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark channel fan-out.')
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--duration', type=float, default=1)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    ctx = bench_context(loop)
+    mammon.server.running_context = ctx
+
+    for size in args.sizes.split(','):
+        for mode in ('per-client', 'channel'):
+            run(loop, ctx, mode, int(size), args.duration)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Inbound framing: LineFramer against the bytes concatenation it replaced.
+
+Feeds a stream to each framer in 1 byte, 512 byte and 64 KiB chunks.
+Streams:
+  lines      80 byte lines, with the usual 512 byte line limit
+  long-line  a single 64 KiB line with no limit, trickled in
+Framers:
+  concat     recv_buffer += data, then replace() and split() over all of it,
+             as ClientProtocol.data_received did
+  feed       LineFramer.feed(), as used with asyncio.Protocol
+  buffered   LineFramer.get_buffer() and buffer_updated(), as used with
+             asyncio.BufferedProtocol, with the copy a transport would make
+
+Each run is repeated --repeat times and the best is reported.
+
+usage: python3 bench/framing.py [--bytes 1048576] [--repeat 3]"""
+
+import argparse
+import time
+
+from leaf import load
+
+LineFramer = load('framing').LineFramer
+
+class ConcatFramer(object):
+    def __init__(self, max_line=None):
+        self.max_line = max_line
+        self.recv_buffer = b''
+
+    def feed(self, data):
+        self.recv_buffer += data
+        recvd = self.recv_buffer.replace(b'\r', b'').split(b'\n')
+        self.recv_buffer = recvd.pop(-1)
+        if self.max_line and len(self.recv_buffer) > self.max_line:
+            self.recv_buffer = self.recv_buffer[:self.max_line]
+        return recvd
+
+def frame_concat(chunks, max_line):
+    framer = ConcatFramer(max_line)
+    count = 0
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+    return count
+
+def frame_feed(chunks, max_line):
+    framer = LineFramer(max_line)
+    count = 0
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+    return count
+
+def frame_buffered(chunks, max_line):
+    framer = LineFramer(max_line)
+    count = 0
+    for chunk in chunks:
+        while chunk:
+            free = framer.get_buffer(len(chunk))
+            nbytes = min(len(free), len(chunk))
+            free[:nbytes] = chunk[:nbytes]
+            count += len(framer.buffer_updated(nbytes))
+            chunk = chunk[nbytes:]
+    return count
+
+framers = (('concat', frame_concat), ('feed', frame_feed), ('buffered', frame_buffered))
+
+def stream(name, size):
+    if name == 'lines':
+        line = b'PRIVMSG #channel :' + b'x' * 60 + b'\r\n'
+        return line * (size // len(line)), 512
+    return b'PRIVMSG #channel :' + b'x' * 65536 + b'\r\n', None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark inbound line framing.')
+    parser.add_argument('--bytes', type=int, default=1048576)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for name in ('lines', 'long-line'):
+        for chunk_size in (1, 512, 65536):
+            # a byte at a time is slow however it's framed, so feed less of it
+            data, max_line = stream(name, args.bytes if chunk_size > 1 else args.bytes // 16)
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+            for framer, frame in framers:
+                elapsed = None
+                for i in range(args.repeat):
+                    started = time.perf_counter()
+                    count = frame(chunks, max_line)
+                    run_time = time.perf_counter() - started
+                    if elapsed is None or run_time < elapsed:
+                        elapsed = run_time
+                print('{:<10} {:>6} byte chunks  {:<9} {:>8.2f} MB/s {:>10.0f} lines/s'.format(
+                    name, chunk_size, framer, len(data) / elapsed / 1048576, count / elapsed))
+
+if __name__ == '__main__':
+    main()
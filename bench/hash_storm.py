@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Login storm: how long SASL/OPER logins wait for their hash, and how long the
+event loop stalls, when many arrive at once.
+
+Each mode verifies --count passphrases submitted together, the way a netsplit
+rejoin or a botnet hits the server, and a 10ms heartbeat on the loop measures
+how late it runs.  Modes:
+  inline     verify on the loop thread, as before hashing moved off it
+  threads    the loop's default thread pool (hashing: workers: 0)
+  processes  HashHandler's process pool (hashing: workers: N)
+
+usage: python3 bench/hash_storm.py [--count 1000] [--workers 2]
+                                   [--scheme sha512_crypt] [--rounds 100000]"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from leaf import load
+
+hashing = load('hashing')
+HashHandler = hashing.HashHandler
+worker_verify = hashing.worker_verify
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Heartbeat:
+    """Reschedules itself every interval and records how late each run was."""
+    def __init__(self, loop, interval=0.01):
+        self.loop = loop
+        self.interval = interval
+        self.lags = []
+        self.running = True
+        self.expected = loop.time() + interval
+        loop.call_later(interval, self.beat)
+
+    def beat(self):
+        now = self.loop.time()
+        self.lags.append(now - self.expected)
+        if self.running:
+            self.expected = now + self.interval
+            self.loop.call_later(self.interval, self.beat)
+
+def run_storm(loop, hashing, mode, count, hash):
+    latencies = []
+    heartbeat = Heartbeat(loop)
+
+    # let the heartbeat settle before the storm
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    started = time.perf_counter()
+    if mode == 'inline':
+        for i in range(count):
+            hashing.verify('benchmark passphrase', hash)
+            latencies.append(time.perf_counter() - started)
+    else:
+        def done(future):
+            latencies.append(time.perf_counter() - started)
+
+        futures = []
+        for i in range(count):
+            future = loop.run_in_executor(hashing.executor, worker_verify, hashing.settings,
+                                          'benchmark passphrase', hash)
+            future.add_done_callback(done)
+            futures.append(future)
+        loop.run_until_complete(asyncio.wait(futures))
+    elapsed = time.perf_counter() - started
+
+    # one more beat so a stall at the end of the storm is counted
+    loop.run_until_complete(asyncio.sleep(0.02))
+    heartbeat.running = False
+
+    print('{:<10} {:>8.1f}/s  latency p50 {:>7.3f}s p99 {:>7.3f}s max {:>7.3f}s  loop lag p99 {:>7.3f}s max {:>7.3f}s'.format(
+        mode, count / elapsed,
+        percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies),
+        percentile(heartbeat.lags, 0.99), max(heartbeat.lags)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark passphrase verification under a login storm.')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--scheme', default='sha512_crypt')
+    parser.add_argument('--rounds', type=int, default=100000)
+    parser.add_argument('--modes', default='inline,threads,processes')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    print('{} logins, {} at {} rounds, {} cpus'.format(args.count, args.scheme, args.rounds, os.cpu_count()))
+
+    for mode in args.modes.split(','):
+        hashing = HashHandler()
+        if not hashing.enabled:
+            print('passlib is not installed')
+            exit(1)
+        hashing.configure({
+            'scheme': args.scheme,
+            'rounds': {args.scheme: args.rounds},
+            'workers': args.workers if mode == 'processes' else 0,
+        })
+        hash = hashing.encrypt('benchmark passphrase')
+        try:
+            run_storm(loop, hashing, mode, args.count, hash)
+        finally:
+            hashing.shutdown()
+
+if __name__ == '__main__':
+    main()
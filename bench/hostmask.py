@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Channel ban lists: HostmaskMatcher against the old loop over every mask.
+
+Builds ban lists of --sizes masks in a realistic mix of shapes (nick!*@*,
+*!*@host, *!*@*.isp.example, *!ident@*, *!*@10.1.2.*, and the odd
+*nick*!*@*), then checks --lookups joining hostmasks against them, about one
+in ten of them banned.  Reports joins checked per second for the old
+ircmatch loop and for HostmaskMatcher, the time to build the matcher, and
+whether both agreed on every hostmask.
+
+usage: python3 bench/hostmask.py [--sizes 10,100,1000,5000] [--lookups 20000]"""
+
+import argparse
+import random
+import time
+
+import ircmatch
+
+from leaf import load
+
+HostmaskMatcher = load('hostmask').HostmaskMatcher
+
+def word(rng, length=8):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(length))
+
+def make_user(rng):
+    nick = word(rng, rng.randint(4, 10))
+    ident = '~' + word(rng, 6)
+    if rng.random() < 0.3:
+        host = '10.{}.{}.{}'.format(rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+    else:
+        host = '{}.{}.{}.example'.format(word(rng, 6), word(rng, 5), rng.choice(('isp', 'net', 'dsl')))
+    return nick, ident, host
+
+def make_ban(rng, user):
+    nick, ident, host = user
+    shape = rng.random()
+    if shape < 0.3:
+        return '*!*@' + host
+    elif shape < 0.5:
+        return nick + '!*@*'
+    elif shape < 0.65:
+        return '*!*@*.' + host.split('.', 1)[1] if not host[0].isdigit() else '*!*@' + host.rsplit('.', 1)[0] + '.*'
+    elif shape < 0.8:
+        return '*!' + ident + '@*'
+    elif shape < 0.95:
+        return '{}!{}@{}'.format(nick, ident, host)
+    return '*{}*!*@*'.format(nick[1:-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark channel ban matching.')
+    parser.add_argument('--sizes', default='10,100,1000,5000')
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for size in [int(s) for s in args.sizes.split(',')]:
+        rng = random.Random(args.seed)
+        banned = [make_user(rng) for i in range(size)]
+        bans = [make_ban(rng, user) for user in banned]
+
+        joins = []
+        for i in range(args.lookups):
+            if rng.random() < 0.1:
+                nick, ident, host = rng.choice(banned)
+            else:
+                nick, ident, host = make_user(rng)
+            joins.append('{}!{}@{}'.format(nick, ident, host))
+
+        started = time.perf_counter()
+        naive = [any(ircmatch.match(0, ban, hostmask) for ban in bans) for hostmask in joins]
+        naive_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        matcher = HostmaskMatcher(bans)
+        build_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        compiled = [matcher.match(hostmask) is not None for hostmask in joins]
+        compiled_time = time.perf_counter() - started
+
+        print('{:>5} bans  loop {:>10.0f} joins/s  matcher {:>10.0f} joins/s  ({:.1f}x)  build {:.1f}ms  {} banned, {}'.format(
+            size, len(joins) / naive_time, len(joins) / compiled_time, naive_time / compiled_time,
+            build_time * 1000, sum(compiled), 'agree' if naive == compiled else 'DISAGREE'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Loads single mammon modules for the benchmarks.
+
+Importing mammon.<name> imports the mammon package first, and with it the
+whole server: ircreactor, and asyncio.async, which is a syntax error from
+Python 3.7 on.  Modules that don't import anything else from mammon can be
+loaded straight from their file instead, under the name mammon_<name>."""
+
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def load(name):
+    """Returns mammon/<name>.py loaded as a top-level module."""
+    module_name = 'mammon_' + name
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, 'mammon', name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    # registered before running it, so pickle can find its functions by name
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
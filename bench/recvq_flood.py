@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Recvq load test: command latency for ordinary clients while others flood.
+
+Simulated clients queue lines into their recvq the way ClientProtocol does,
+pausing when it reaches recvq_len, and each dispatched line costs --handler-us
+of CPU.  Ordinary clients send one line a second; flooders send as fast as
+their recvq lets them.  Modes:
+  drain      every line is handled as soon as it arrives, as before the
+             scheduler (a flooder gets as much CPU as it can send)
+  scheduler  RecvQScheduler with flood buckets (flood: rate, burst and
+             lines_per_tick from mammond.yml)
+Latency is from when a line was due to be sent to its handler running, so
+time spent waiting for a busy event loop to read it counts too.
+
+usage: python3 bench/recvq_flood.py [--clients 200] [--flooders 0,1,10]
+                                    [--duration 5] [--handler-us 200]"""
+
+import argparse
+import asyncio
+import collections
+import random
+import time
+
+from leaf import load
+
+Clock = load('clock').Clock
+recvq = load('recvq')
+RecvQScheduler = recvq.RecvQScheduler
+TokenBucket = recvq.TokenBucket
+
+class BenchContext:
+    def __init__(self, loop, args):
+        self.eventloop = loop
+        self.clock = Clock()
+        self.flood_rate = 4
+        self.flood_burst = 20
+        self.flood_lines_per_tick = 4
+        self.recvq_len = 20
+        self.handler_cost = args.handler_us / 1000000.0
+        self.recvq_scheduler = RecvQScheduler(self)
+
+class BenchClient:
+    """The recvq side of ClientProtocol, with a handler that just burns CPU."""
+    def __init__(self, ctx, nickname, flooder):
+        self.ctx = ctx
+        self.nickname = nickname
+        self.flooder = flooder
+        self.connected = True
+        self.recvq = collections.deque()
+        self.flood = TokenBucket(ctx.flood_rate, ctx.flood_burst, ctx.clock.monotonic())
+        self.reading_paused = False
+        self.latencies = []
+        self.handled = 0
+
+    def message_received(self, mode, sent):
+        if len(self.recvq) >= self.ctx.recvq_len:
+            # a paused transport: the line stays in the kernel, and the sender with it
+            self.reading_paused = True
+            return False
+        self.recvq.append(sent)
+
+        if mode == 'drain':
+            self.drain_queue()
+        else:
+            self.ctx.recvq_scheduler.schedule(self)
+        return True
+
+    def drain_queue(self, limit=None):
+        processed = 0
+        while self.recvq and self.connected:
+            if limit is not None and processed >= limit:
+                break
+
+            now = self.ctx.clock.monotonic()
+            if limit is not None:
+                if not self.flood.ready(now):
+                    break
+                self.flood.consume(1, now)
+
+            sent = self.recvq.popleft()
+            deadline = time.perf_counter() + self.ctx.handler_cost
+            while time.perf_counter() < deadline:
+                pass
+            self.latencies.append(self.ctx.eventloop.time() - sent)
+            self.handled += 1
+            processed += 1
+
+        if self.reading_paused and len(self.recvq) < self.ctx.recvq_len:
+            self.reading_paused = False
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(args, mode, flooders):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ctx = BenchContext(loop, args)
+    stop_at = loop.time() + args.duration
+
+    def talk(cli, sent):
+        if loop.time() >= stop_at:
+            return
+        cli.message_received(mode, sent)
+        loop.call_at(sent + 1, talk, cli, sent + 1)
+
+    def flood(cli):
+        if loop.time() >= stop_at:
+            return
+        # one read's worth of pasted lines, until the recvq fills up
+        for i in range(50):
+            if not cli.message_received(mode, loop.time()):
+                break
+        loop.call_soon(flood, cli)
+
+    clients = [BenchClient(ctx, 'user{}'.format(i), False) for i in range(args.clients)]
+    flooding = [BenchClient(ctx, 'flood{}'.format(i), True) for i in range(flooders)]
+    for cli in clients:
+        sent = loop.time() + random.random()
+        loop.call_at(sent, talk, cli, sent)
+    for cli in flooding:
+        loop.call_soon(flood, cli)
+
+    loop.run_until_complete(asyncio.sleep(args.duration + 0.5))
+    loop.close()
+
+    latencies = [l for cli in clients for l in cli.latencies]
+    print('{:<10} flooders {:>3}  clients p50 {:>8.2f}ms p99 {:>8.2f}ms max {:>8.2f}ms  flood lines handled {:>7}'.format(
+        mode, flooders,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies or [0]) * 1000,
+        sum(cli.handled for cli in flooding)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure command latency while some clients flood.')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--flooders', default='0,1,10')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--handler-us', type=int, default=200)
+    args = parser.parse_args()
+
+    print('{} clients at 1 line/s, {:.1f}s, {}us per line'.format(args.clients, args.duration, args.handler_us))
+    for mode in ('drain', 'scheduler'):
+        for flooders in args.flooders.split(','):
+            run(args, mode, int(flooders))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Outbound coalescing over TLS: write syscalls and CPU per registration burst.
+
+A TLS listener sends --bursts bursts of --lines lines (a registration with its
+MOTD, NAMES and TOPICs is a few hundred) to a reader in another process, which
+just counts the bytes.  Modes:
+  per-line   transport.write for every line, as before the sendq
+  sendq      ClientProtocol.dump_raw, which flushes once per loop iteration
+Reported for the server process, per burst: wall time, CPU time (mostly TLS),
+and writes of encrypted data to the socket transport, each of which is a send
+syscall when the socket isn't backed up.
+
+The sendq mode drives the real ClientProtocol, so it needs everything the
+server needs: ircreactor, and Python 3.6 or older, as mammon still uses
+asyncio.async.
+
+usage: python3 bench/sendq_tls.py [--bursts 2000] [--lines 300]
+                                  [--certfile cert.pem --keyfile key.pem]"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def count_socket_writes(transport, stats):
+    """Counts the encrypted writes under an asyncio TLS transport.  This reaches into
+    asyncio's sslproto, so it's left at zero where that looks different."""
+    raw = getattr(getattr(transport, '_ssl_protocol', None), '_transport', None)
+    if raw is None:
+        return
+    write = raw.write
+    def counted_write(data):
+        stats['writes'] += 1
+        write(data)
+    raw.write = counted_write
+
+def reader(port, total):
+    """The other end: read total bytes over TLS, then say so."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        with context.wrap_socket(sock) as tls:
+            received = 0
+            while received < total:
+                data = tls.recv(262144)
+                if not data:
+                    break
+                received += len(data)
+            tls.sendall(b'x')
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+def run(args, mode, context):
+    from mammon.client import ClientProtocol
+
+    loop = asyncio.get_event_loop()
+    lines = [':bench.example.com 372 user :- {:03d} {}\r\n'.format(i, 'x' * 60).encode('utf-8') for i in range(args.lines)]
+    total = sum(len(line) for line in lines) * args.bursts
+    finished = asyncio.Future()
+    stats = {}
+
+    class BenchProtocol(ClientProtocol):
+        """A connected client with just the sendq side of ClientProtocol."""
+        def connection_made(self, transport):
+            self.ctx = types.SimpleNamespace(eventloop=loop, roles=dict(), logger=logging.getLogger(''),
+                                             sendq_flush_threshold=16384, sendq_limit=1 << 40)
+            self.transport = transport
+            self.sendq = list()
+            self.sendq_len = 0
+            self.sendq_flush_pending = False
+            self.sendq_exceeded = False
+            self.lines_sent = 0
+            self.writing_paused = False
+            self.connected = True
+            self.nickname = 'user'
+            self._role_name = None
+            self.bursts = 0
+            self.waiting = False
+
+            stats['writes'] = 0
+            count_socket_writes(transport, stats)
+            stats['cpu'] = time.process_time()
+            stats['wall'] = time.perf_counter()
+            self.send_burst()
+
+        def send_burst(self):
+            if self.writing_paused:
+                self.waiting = True
+                return
+
+            if mode == 'per-line':
+                for line in lines:
+                    self.transport.write(line)
+            else:
+                for line in lines:
+                    self.dump_raw(line)
+
+            self.bursts += 1
+            if self.bursts < args.bursts:
+                # the next batch of input, after this one's flush
+                loop.call_soon(self.send_burst)
+
+        def resume_writing(self):
+            super(BenchProtocol, self).resume_writing()
+            if self.waiting:
+                self.waiting = False
+                self.send_burst()
+
+        def got_ack(self):
+            if not finished.done():
+                stats['cpu'] = time.process_time() - stats['cpu']
+                stats['wall'] = time.perf_counter() - stats['wall']
+                finished.set_result(True)
+
+        def data_received(self, data):
+            self.got_ack()
+
+        def get_buffer(self, sizehint):
+            return bytearray(256)
+
+        def buffer_updated(self, nbytes):
+            self.got_ack()
+
+        def connection_lost(self, exc):
+            self.connected = False
+
+    server = loop.run_until_complete(loop.create_server(BenchProtocol, '127.0.0.1', 0, ssl=context))
+    port = server.sockets[0].getsockname()[1]
+
+    client = subprocess.Popen([sys.executable, sys.argv[0], '--reader', str(port), str(total)])
+    loop.run_until_complete(finished)
+    client.wait()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+    print('{:<9} {:>8.2f}ms wall {:>8.2f}ms cpu {:>8.1f} socket writes  per burst  ({:.0f} MB/s)'.format(
+        mode, stats['wall'] * 1000 / args.bursts, stats['cpu'] * 1000 / args.bursts,
+        stats['writes'] / float(args.bursts), total / stats['wall'] / 1048576))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark outbound line coalescing over TLS.')
+    parser.add_argument('--bursts', type=int, default=2000)
+    parser.add_argument('--lines', type=int, default=300)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--reader', nargs=2, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.reader:
+        reader(*args.reader)
+        return
+
+    directory = None
+    certfile, keyfile = args.certfile, args.keyfile
+    if not certfile:
+        directory = tempfile.mkdtemp()
+        certfile, keyfile = make_certificate(directory)
+
+    try:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+
+        print('{} bursts of {} lines over TLS'.format(args.bursts, args.lines))
+        for mode in ('per-line', 'sendq'):
+            run(args, mode, context)
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Ping timers for many idle clients: call_later handles against the TimerWheel.
+
+Every client has a ping and a ping-timeout timer, re-armed whenever it sends
+anything.  For 10k, 50k and 100k clients this arms them all, then re-arms
+them all --rounds times (a PING/PONG or PRIVMSG each), running one event loop
+iteration after every round.  Modes:
+  call_later  cancel both handles and create new ones, as update_pings did
+  wheel       TimerWheel.schedule, an O(1) move between per-second buckets
+Reported: CPU per re-arm, the event loop's timer heap size (cancelled handles
+stay in it until asyncio cleans up), objects left allocated including the
+clients themselves, and the CPU of one tick of the wheel.
+
+usage: python3 bench/timers.py [--clients 10000,50000,100000] [--rounds 5]"""
+
+import argparse
+import asyncio
+import gc
+import sys
+import time
+
+from leaf import load
+
+TimerWheel = load('timers').TimerWheel
+
+PING_FREQUENCY = 120
+PING_TIMEOUT = 240
+
+class CallLaterClient(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.ping_future = None
+        self.ping_timeout_future = None
+
+    def rearm(self, now):
+        if self.ping_future:
+            self.ping_future.cancel()
+        self.ping_future = self.loop.call_later(PING_FREQUENCY, self.dump_ping)
+        if self.ping_timeout_future:
+            self.ping_timeout_future.cancel()
+        self.ping_timeout_future = self.loop.call_later(PING_TIMEOUT, self.ping_timeout)
+
+    def dump_ping(self):
+        pass
+
+    def ping_timeout(self):
+        pass
+
+class WheelClient(object):
+    def __init__(self, wheel):
+        self.wheel = wheel
+
+    def rearm(self, now):
+        self.wheel.schedule(self.dump_ping, PING_FREQUENCY, now)
+        self.wheel.schedule(self.ping_timeout, PING_TIMEOUT, now)
+
+    def dump_ping(self):
+        pass
+
+    def ping_timeout(self):
+        pass
+
+def run(mode, count, rounds):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    wheel = TimerWheel(time.monotonic())
+
+    if mode == 'wheel':
+        clients = [WheelClient(wheel) for i in range(count)]
+    else:
+        clients = [CallLaterClient(loop) for i in range(count)]
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+
+    # connect
+    now = time.monotonic()
+    for cli in clients:
+        cli.rearm(now)
+    loop.run_until_complete(asyncio.sleep(0))
+
+    cpu = 0.0
+    for i in range(rounds):
+        started = time.process_time()
+        now = time.monotonic()
+        for cli in clients:
+            cli.rearm(now)
+        loop.run_until_complete(asyncio.sleep(0))
+        cpu += time.process_time() - started
+
+    gc.collect()
+    blocks = sys.getallocatedblocks() - blocks
+    heap = len(getattr(loop, '_scheduled', ()))
+
+    # a tick with nothing due, as update_ts_callback runs it every second
+    tick = '-'
+    if mode == 'wheel':
+        started = time.process_time()
+        wheel.advance(time.monotonic())
+        tick = '{:.3f}ms'.format((time.process_time() - started) * 1000)
+
+    print('{:<10} {:>7} clients {:>7.2f}us/re-arm {:>8} timers in loop heap {:>9} objects allocated {:>8} per tick'.format(
+        mode, count, cpu / (rounds * count) * 1000000, heap, blocks, tick))
+
+    loop.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark client ping timers.')
+    parser.add_argument('--clients', default='10000,50000,100000')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    for count in args.clients.split(','):
+        for mode in ('call_later', 'wheel'):
+            run(mode, int(count), args.rounds)
+
+if __name__ == '__main__':
+    main()
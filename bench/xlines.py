@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""K-line and D-line lookups: HostmaskMatcher and CidrTree against a linear scan.
+
+For --sizes entries of each kind, checks connecting clients the way the
+server does: the address against the D-lines (CidrTree.covering) and
+user@host and user@ip against the K-lines (HostmaskMatcher.match).  The
+linear scan tests every entry in turn, as a list of ip_networks and a loop
+of ircmatch globs; it only gets --scan-lookups clients since it's slow.
+Reports lookups per second and whether both found the same bans for the
+clients the scan checked.
+
+usage: python3 bench/xlines.py [--sizes 1000,10000,100000] [--lookups 20000]"""
+
+import argparse
+import ipaddress
+import random
+import time
+
+import ircmatch
+
+from leaf import load
+
+CidrTree = load('cidr').CidrTree
+HostmaskMatcher = load('hostmask').HostmaskMatcher
+
+def word(rng, length):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(length))
+
+def make_address(rng):
+    if rng.random() < 0.8:
+        return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+    return str(ipaddress.IPv6Address((0x2001 << 112) | rng.getrandbits(96)))
+
+def make_dline(rng):
+    address = make_address(rng)
+    if ':' in address:
+        prefix = rng.choice((48, 64, 128))
+    else:
+        prefix = rng.choice((16, 24, 24, 32, 32, 32))
+    return str(ipaddress.ip_network('{}/{}'.format(address, prefix), strict=False))
+
+def make_host(rng):
+    return '{}.{}.{}.example'.format(word(rng, 6), word(rng, 5), rng.choice(('isp', 'net', 'dsl')))
+
+def make_kline(rng):
+    shape = rng.random()
+    if shape < 0.5:
+        return '*@' + make_host(rng)
+    elif shape < 0.7:
+        return '*@*.' + make_host(rng).split('.', 1)[1]
+    elif shape < 0.9:
+        return '~{}@*'.format(word(rng, 6))
+    return '*@' + make_address(rng)
+
+def banned_by(kline, host):
+    """Returns a username (or None) and a host that kline matches."""
+    user, sep, mask = kline.partition('@')
+    if mask == '*':
+        return user, host
+    if mask.startswith('*.'):
+        return None, 'host' + mask[1:]
+    return None, mask
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark K-line and D-line lookups.')
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--scan-lookups', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for size in [int(s) for s in args.sizes.split(',')]:
+        rng = random.Random(args.seed)
+        dlines = [make_dline(rng) for i in range(size)]
+        klines = [make_kline(rng) for i in range(size)]
+
+        tree = CidrTree()
+        for network in dlines:
+            tree.insert(network, network)
+        matcher = HostmaskMatcher(klines)
+        networks = [ipaddress.ip_network(network) for network in dlines]
+
+        # one in twenty clients picked from a D-line and one in twenty from a
+        # K-line; with many entries random addresses get D-lined too
+        clients = []
+        for i in range(args.lookups):
+            username, host, address = '~' + word(rng, 6), make_host(rng), make_address(rng)
+            if rng.random() < 0.05:
+                address = str(rng.choice(networks).network_address)
+            if rng.random() < 0.05:
+                user, host = banned_by(rng.choice(klines), host)
+                username = user or username
+                if host[0].isdigit() or ':' in host:
+                    address = host
+            clients.append((username, host, address))
+
+        def indexed(client):
+            username, host, address = client
+            dline = next(tree.covering(address), None)
+            kline = matcher.match('{}@{}'.format(username, host)) or matcher.match('{}@{}'.format(username, address))
+            return dline is not None, kline is not None
+
+        def scan(client):
+            username, host, address = client
+            ip = ipaddress.ip_address(address)
+            dline = any(ip in network for network in networks if network.version == ip.version)
+            kline = any(ircmatch.match(0, mask, '{}@{}'.format(username, h)) for h in (host, address) for mask in klines)
+            return dline, kline
+
+        started = time.perf_counter()
+        found = [indexed(client) for client in clients]
+        indexed_time = time.perf_counter() - started
+
+        sample = clients[:args.scan_lookups]
+        started = time.perf_counter()
+        scanned = [scan(client) for client in sample]
+        scan_time = time.perf_counter() - started
+
+        print('{:>6} entries  scan {:>8.0f} lookups/s  indexed {:>8.0f} lookups/s  {} D-lined, {} K-lined, {}'.format(
+            size, len(sample) / scan_time, len(clients) / indexed_time,
+            sum(d for d, k in found), sum(k for d, k in found),
+            'agree' if scanned == found[:len(sample)] else 'DISAGREE'))
+
+if __name__ == '__main__':
+    main()
@@ -49,8 +49,11 @@ def m_CAP_LS(cli, ev_msg):
     if len(ev_msg['params']) > 1:
         cli.cap_version = int(ev_msg['params'][1])
     is_ircv3_2 = len(ev_msg['params']) > 1 and cli.cap_version > 301
-    if is_ircv3_2:
-        cli.caps['cap-notify'] = caplist['cap-notify']
+    if is_ircv3_2 and 'cap-notify' not in cli.caps:
+        eventmgr_core.dispatch('cap add', {
+            'client': cli,
+            'caps': ['cap-notify'],
+        })
 
     l = list()
     caps = list(caplist.values())
@@ -81,13 +84,11 @@ def m_CAP_LIST(cli, ev_msg):
     cli.dump_numeric('CAP', ['LIST', ' '.join(l)])
 
 def m_CAP_CLEAR(cli, ev_msg):
-    to_remove = list(filter(lambda x: not x.sticky, cli.caps.values()))
+    to_remove = [cap.name for cap in cli.caps.values() if not cap.sticky]
 
     changelist = list()
-    while to_remove:
-        cap = to_remove.pop(0)
-        cap = cli.caps.pop(cap.name)
-        changelist.append('-' + cap.name)
+    for name in to_remove:
+        changelist.append('-' + name)
         if len(changelist) > 8:
             cli.dump_numeric('CAP', ['ACK', ' '.join(changelist)])
             changelist = list()
@@ -95,6 +96,13 @@ def m_CAP_CLEAR(cli, ev_msg):
     if changelist:
         cli.dump_numeric('CAP', ['ACK', ' '.join(changelist)])
 
+    if to_remove:
+        info = {
+            'client': cli,
+            'caps': to_remove,
+        }
+        eventmgr_core.dispatch('cap del', info)
+
 def m_CAP_END(cli, ev_msg):
     cli.release_registration_lock('CAP')
 
@@ -20,8 +20,15 @@ from .capability import Capability
 from .utility import validate_chan, CaseInsensitiveDict, CaseInsensitiveList
 from .server import get_context
 from .property import member_property_items, channel_property_items, channel_flag_items
+from .hostmask import HostmaskMatcher
+import collections
 import copy
-from ircmatch import match
+import itertools
+import weakref
+
+# membership changes are stamped from a single counter, so a tuple of channel
+# generations uniquely identifies a client's set of common peers.
+membership_generations = itertools.count(1)
 
 class ChannelManager(object):
     def __init__(self, ctx):
@@ -82,7 +89,10 @@ class ChannelMembership(object):
 class Channel(object):
     def __init__(self, name):
         self.name = name
-        self.members = []
+        self.members = collections.OrderedDict()   # client -> membership, in join order
+        self.member_nicks = CaseInsensitiveDict()  # nickname -> membership
+        self.cap_members = dict()                  # casefolded cap name -> set of member clients
+        self.generation = next(membership_generations)
         self.topic = str()
         self.topic_setter = str()
         self.topic_ts = 0
@@ -90,50 +100,93 @@ class Channel(object):
         self.user_set_metadata = CaseInsensitiveList()
         self.props_ts = 0
         self.metadata = CaseInsensitiveDict()
+        self.matchers = dict()                     # list prop (ban, exemption, ...) -> HostmaskMatcher
+        self.list_generation = 0                   # bumped whenever a list prop changes
+        self.ban_cache = weakref.WeakKeyDictionary()    # client -> ((list gen, mask gen), ban status)
 
     def authorize(self, cli, ev_msg):
         if 'key' in self.props and (len(ev_msg['params']) < 2 or self.props['key'] != ev_msg['params'][1]):
             cli.dump_numeric('475', [self.name, 'Cannot join channel (+k) - bad key'])
             return False
-        if 'exempt' in self.props:
-            for e in self.props['exempt']:
-                if match(0, e, cli.hostmask):
-                    return True
-        if 'ban' in self.props:
-            for b in self.props['ban']:
-                if match(0, b, cli.hostmask):
-                    cli.dump_numeric('474', [self.name, 'You are banned.'])
-                    return False
+        exempt, banned = self.ban_status(cli)
+        if exempt:
+            return True
+        if banned:
+            cli.dump_numeric('474', [self.name, 'You are banned.'])
+            return False
         if 'invite' in self.props and 'invite-exemption' in self.props:
-            for i in self.props['invite-exemption']:
-                if match(0, i, cli.hostmask):
-                    return True
-                # XXX - /invite command
+            if self.list_match('invite-exemption', cli.hostmask):
+                return True
+            # XXX - /invite command
             return False
         return True
 
+    def list_match(self, prop, hostmask):
+        """Returns the first mask in a list mode (ban, exemption, ...) matching hostmask, or None."""
+        if not self.props.get(prop, None):
+            return None
+        matcher = self.matchers.get(prop, None)
+        if matcher is None:
+            matcher = self.matchers[prop] = HostmaskMatcher(self.props[prop])
+        return matcher.match(hostmask)
+
+    def ban_status(self, client):
+        """Returns (exempt, banned) for client.  The result is cached until
+        a list prop changes or the client's nick, user, host or account does."""
+        key = (self.list_generation, client.mask_generation)
+        cached = self.ban_cache.get(client, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        hostmask = client.hostmask
+        if self.list_match('exemption', hostmask):
+            status = (True, False)
+        else:
+            status = (False, self.list_match('ban', hostmask) is not None)
+
+        self.ban_cache[client] = (key, status)
+        return status
+
     def join(self, client):
         m = ChannelMembership(client, self)
-        self.members.append(m)
-        client.channels.append(m)
+        self.members[client] = m
+        self.member_nicks[client.nickname] = m
+        self.add_member_caps(client, client.caps)
+        self.generation = next(membership_generations)
+        client.channels[self] = m
 
     def part(self, client):
-        for m in filter(lambda x: x.client == client, self.members):
-            self.members.remove(m)
-            if m in client.channels:
-                client.channels.remove(m)
+        m = self.members.pop(client, None)
+        if not m:
+            return
+        self.member_nicks.pop(client.nickname, None)
+        self.remove_member_caps(client, client.caps)
+        self.generation = next(membership_generations)
+        client.channels.pop(self, None)
+
+    def add_member_caps(self, client, caps):
+        for cap in caps:
+            self.cap_members.setdefault(cap.casefold(), set()).add(client)
+
+    def remove_member_caps(self, client, caps):
+        for cap in caps:
+            members = self.cap_members.get(cap.casefold(), None)
+            if members:
+                members.discard(client)
+
+    def rename_member(self, old_nickname, new_nickname):
+        m = self.member_nicks.pop(old_nickname, None)
+        if m:
+            self.member_nicks[new_nickname] = m
 
     def has_member(self, client):
-        matches = tuple(filter(lambda x: x.client == client, self.members))
-        return len(matches) > 0
+        return client in self.members
 
     def get_member(self, client):
-        matches = tuple(filter(lambda x: x.client == client, self.members))
-        return len(matches) > 0 and matches[0]
+        return self.members.get(client, False)
 
     def find_member(self, nickname):
-        matches = tuple(filter(lambda x: x.client.nickname == nickname, self.members))
-        return len(matches) > 0 and matches[0]
+        return self.member_nicks.get(nickname, False)
 
     def can_send(self, client):
         member = self.get_member(client)
@@ -156,22 +209,31 @@ class Channel(object):
         if local_only:
             ctx = get_context()
 
-        for m in self.members:
-            if m.client in exclusion_list:
-                continue
-            if local_only and m.client.servername != ctx.conf.name:
-                continue
-            if cap and cap not in m.client.caps:
+        # cap-filtered broadcasts only walk the members that have the cap
+        if cap:
+            recipients = self.cap_members.get(cap.casefold(), ())
+        else:
+            recipients = self.members
+        if exclude_cap:
+            excluded = self.cap_members.get(exclude_cap.casefold(), ())
+        else:
+            excluded = ()
+
+        # the message is only serialized once per message variant
+        cache = dict()
+
+        for client in recipients:
+            if client in exclusion_list or client in excluded:
                 continue
-            if exclude_cap and exclude_cap in m.client.caps:
+            if local_only and client.servername != ctx.conf.name:
                 continue
 
-            m.client.dump_message(msg)
+            client.dump_message(msg, cache=cache)
 
     def set_legacy_modes(self, client, in_str, args):
 
         before = copy.deepcopy(self.props)
-        before_users = copy.deepcopy({member.client.nickname: member.props for member in self.members})
+        before_users = copy.deepcopy({member.client.nickname: member.props for member in self.members.values()})
 
         mod = False
         for i in in_str:
@@ -196,10 +258,17 @@ class Channel(object):
                         client.dump_numeric('482', [self.name, 'You\'re not a channel operator'])
                         continue
                     arg = args.pop(0)
+                    matcher = self.matchers.get(prop, None)
                     if mod == False and arg in self.props[prop]:
                         del(self.props[prop][arg])
+                        if matcher is not None:
+                            matcher.remove(arg)
+                        self.list_generation += 1
                     if mod == True:
                         self.props[prop][arg] = (client.hostmask, client.ctx.current_ts)
+                        if matcher is not None:
+                            matcher.add(arg)
+                        self.list_generation += 1
                     continue
                 if not self.get_member(client).props.get('set-modes', False):
                     client.dump_numeric('482', [self.name, 'You\'re not a channel operator'])
@@ -210,7 +279,7 @@ class Channel(object):
                     continue
 
         self.flush_legacy_mode_change(client, before, self.props,
-                                      before_users, {member.client.nickname: member.props for member in self.members})
+                                      before_users, {member.client.nickname: member.props for member in self.members.values()})
 
 
     def flush_legacy_mode_change(self, cli, before, after, before_users, after_users):
@@ -315,6 +384,18 @@ def m_JOIN(cli, ev_msg):
 
 cap_extended_join = Capability('extended-join')
 
+@eventmgr_core.handler('cap add', priority=2)
+def m_cap_add_channels(info):
+    cli = info['client']
+    for ch in cli.channels:
+        ch.add_member_caps(cli, info['caps'])
+
+@eventmgr_core.handler('cap del', priority=2)
+def m_cap_del_channels(info):
+    cli = info['client']
+    for ch in cli.channels:
+        ch.remove_member_caps(cli, info['caps'])
+
 @eventmgr_core.handler('channel join', priority=1)
 def m_join_channel(info):
     ch = info['channel']
@@ -375,7 +456,7 @@ def m_part_channel(info):
 
 cap_userhost_in_names = Capability('userhost-in-names')
 
-@eventmgr_rfc1459.message('NAMES', min_params=1)
+@eventmgr_rfc1459.message('NAMES', min_params=1, cost=2)
 def m_NAMES(cli, ev_msg):
     chanlist = ev_msg['params'][0].split(',')
 
@@ -395,9 +476,9 @@ def m_NAMES(cli, ev_msg):
 
         # XXX - this may need to be split up if we start enforcing an outbound packet size
         if 'userhost-in-names' in cli.caps:
-            cli.dump_numeric('353', [ch.classification, ch.name, ' '.join([m.hostmask for m in filter(names_f, ch.members)])])
+            cli.dump_numeric('353', [ch.classification, ch.name, ' '.join([m.hostmask for m in filter(names_f, ch.members.values())])])
         else:
-            cli.dump_numeric('353', [ch.classification, ch.name, ' '.join([m.name for m in filter(names_f, ch.members)])])
+            cli.dump_numeric('353', [ch.classification, ch.name, ' '.join([m.name for m in filter(names_f, ch.members.values())])])
         cli.dump_numeric('366', [ch.name, 'End of /NAMES list.'])
 
 @eventmgr_rfc1459.message('TOPIC', min_params=1, update_idle=True)
@@ -449,7 +530,7 @@ def m_TOPIC(cli, ev_msg):
         ch.dump_message(RFC1459Message.from_data('TOPIC', source=cli, params=[ch.name, ch.topic]))
 
 # XXX - handle ELIST
-@eventmgr_rfc1459.message('LIST')
+@eventmgr_rfc1459.message('LIST', cost=5)
 def m_LIST(cli, ev_msg):
     cli.dump_numeric('321', ['Channel', 'Users', 'Topic'])
 
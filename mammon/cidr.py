@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import ipaddress
+
+class CidrTree(object):
+    """Maps IPv4 and IPv6 networks to values.
+
+    Each address family is a binary trie with one level per prefix bit, so
+    finding the networks covering an address walks at most 32 or 128 nodes
+    however many networks there are.  IPv4-mapped IPv6 addresses are looked up
+    as IPv4."""
+    def __init__(self):
+        # node: [zero child, one child, value]
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def parse_network(network):
+        """Returns network as an ip_network, host bits cleared.  Raises ValueError."""
+        return ipaddress.ip_network(network, strict=False)
+
+    def path(self, network, create=False):
+        network = self.parse_network(network)
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+
+        node = self.roots[network.version]
+        nodes = [node]
+        for i in range(network.prefixlen):
+            bit = (bits >> (width - 1 - i)) & 1
+            if node[bit] is None:
+                if not create:
+                    return None
+                node[bit] = [None, None, None]
+            node = node[bit]
+            nodes.append(node)
+        return nodes
+
+    def insert(self, network, value):
+        node = self.path(network, create=True)[-1]
+        if node[2] is None:
+            self.count += 1
+        node[2] = value
+
+    def get(self, network, default=None):
+        nodes = self.path(network)
+        if nodes is None or nodes[-1][2] is None:
+            return default
+        return nodes[-1][2]
+
+    def remove(self, network):
+        nodes = self.path(network)
+        if nodes is None or nodes[-1][2] is None:
+            return False
+        nodes[-1][2] = None
+        self.count -= 1
+
+        # prune the nodes left empty on the way back up
+        while len(nodes) > 1:
+            node = nodes.pop()
+            if node[0] is not None or node[1] is not None or node[2] is not None:
+                break
+            parent = nodes[-1]
+            parent[0 if parent[0] is node else 1] = None
+        return True
+
+    def covering(self, address):
+        """Yields the values of the networks containing address, least specific first.
+        Addresses that don't parse are covered by nothing."""
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        bits = int(address)
+        width = address.max_prefixlen
+        node = self.roots[address.version]
+        for i in range(width + 1):
+            if node[2] is not None:
+                yield node[2]
+            if i == width:
+                break
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                break
@@ -19,12 +19,17 @@ import asyncio
 import time
 import socket
 import copy
+import collections
 import functools
+import hashlib
+import itertools
 
 from ircreactor.envelope import RFC1459Message
 from .capability import Capability
 from .channel import Channel
-from .utility import CaseInsensitiveDict, CaseInsensitiveList, CaseInsensitiveSet, uniq, validate_hostname
+from .framing import LineFramer
+from .recvq import TokenBucket
+from .utility import CaseInsensitiveDict, CaseInsensitiveList, CaseInsensitiveSet, validate_hostname
 from .property import user_property_items, user_mode_items
 from .server import eventmgr_rfc1459, eventmgr_core, get_context
 from .isupport import get_isupport
@@ -33,6 +38,11 @@ from . import __version__
 cap_account_tag = Capability('account-tag')
 client_registration_locks = ['NICK', 'USER', 'DNS']
 
+# capabilities that change how an outbound message is rendered.  clients that
+# share the same set of these see identical bytes, so fan-out only needs to
+# serialize a message once per distinct combination.
+message_variant_caps = ['account-tag']
+
 class ClientHistoryEntry(object):
     def __init__(self, cli):
         self.nickname = cli.nickname
@@ -45,8 +55,33 @@ class ClientHistoryEntry(object):
     def register(self):
         self.ctx.client_history[self.nickname] = self
 
+# where asyncio has BufferedProtocol, the transport reads straight into our framing buffer
+ProtocolBase = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+# changes to what bans match against are stamped from a single counter, so
+# channels can cache a client's ban status until it changes
+mask_generations = itertools.count(1)
+
+def mask_property(name):
+    """A client attribute that moves the client to a new mask generation when set."""
+    attr = '_' + name
+
+    def getter(self):
+        return getattr(self, attr)
+
+    def setter(self, value):
+        setattr(self, attr, value)
+        self.mask_generation = next(mask_generations)
+
+    return property(getter, setter)
+
 # XXX - quit() could eventually be handled using self.eventmgr.dispatch()
-class ClientProtocol(asyncio.Protocol):
+class ClientProtocol(ProtocolBase):
+    nickname = mask_property('nickname')
+    username = mask_property('username')
+    hostname = mask_property('hostname')
+    account = mask_property('account')
+
     def connection_made(self, transport):
         self.ctx = get_context()
 
@@ -61,10 +96,26 @@ class ClientProtocol(asyncio.Protocol):
             pn[0] = '0' + self.peername[0]
             self.peername = tuple(pn)
 
+        # D-lines are checked before we spend anything on DNS or ident
+        dline = self.ctx.xlines.find_dline(self.peername[0])
+        if dline:
+            self.connected = False
+            transport.write('ERROR :Closing Link: {0} (D-lined: {1})\r\n'.format(self.peername[0], dline['reason']).encode('UTF-8', 'replace'))
+            transport.close()
+            return
+
         self.transport = transport
-        self.recvq = list()
-        self.recv_buffer = b''
-        self.channels = list()
+        self.recvq = collections.deque()
+        self.flood = TokenBucket(self.ctx.flood_rate, self.ctx.flood_burst, self.ctx.clock.monotonic())
+        self.framer = LineFramer(self.ctx.conf.limits.get('line', None))
+        self.sendq = list()
+        self.sendq_len = 0
+        self.sendq_flush_pending = False
+        self.sendq_exceeded = False
+        self.lines_sent = 0
+        self.reading_paused = False
+        self.writing_paused = False
+        self.channels = collections.OrderedDict()   # channel -> membership, in join order
         self.nickname = '*'
         self.username = str()
         self.hostname = self.peername[0]
@@ -77,6 +128,8 @@ class ClientProtocol(asyncio.Protocol):
         self.metadata = CaseInsensitiveDict()
         self.servername = self.ctx.conf.name
         self.monitoring = CaseInsensitiveSet()
+        self._common_peers = frozenset([self])
+        self._common_peers_key = ()
 
         self.away_message = str()
         self._role_name = None
@@ -94,10 +147,17 @@ class ClientProtocol(asyncio.Protocol):
         if self.tls:
             self.props['special:tls'] = True
 
+        # sha256 of the client certificate, the handshake is done by now
+        self.certfp = None
+        if self.tls:
+            ssl_object = self.transport.get_extra_info('ssl_object', default=None) or self.transport.get_extra_info('socket', default=None)
+            peercert = getattr(ssl_object, 'getpeercert', None)
+            der = peercert(binary_form=True) if peercert else None
+            if der:
+                self.certfp = hashlib.sha256(der).hexdigest()
+
         self.ping_cookie = None
         self.ping_timeout_handler = functools.partial(self.quit, 'Ping timeout: {} seconds'.format(int(self.ctx.ping_timeout)))
-        self.ping_future = None
-        self.ping_timeout_future = None
         self.update_pings()
         self.update_idle()
 
@@ -107,16 +167,13 @@ class ClientProtocol(asyncio.Protocol):
         })
 
     def update_idle(self):
-        self.last_event_ts = self.ctx.current_ts
+        self.last_event_ts = self.ctx.clock.monotonic()
         self.update_pings()
 
     def update_pings(self):
-        if self.ping_future:
-            self.ping_future.cancel()
-        self.ping_future = self.ctx.eventloop.call_later(self.ctx.ping_frequency, self.dump_ping)
-        if self.ping_timeout_future:
-            self.ping_timeout_future.cancel()
-        self.ping_timeout_future = self.ctx.eventloop.call_later(self.ctx.ping_timeout, self.ping_timeout_handler)
+        now = self.ctx.clock.monotonic()
+        self.ctx.timers.schedule(self.dump_ping, self.ctx.ping_frequency, now)
+        self.ctx.timers.schedule(self.ping_timeout_handler, self.ctx.ping_timeout, now)
 
     def dump_ping(self):
         self.ping_cookie = int(self.ctx.current_ts)
@@ -132,7 +189,7 @@ class ClientProtocol(asyncio.Protocol):
 
     @property
     def idle_time(self):
-        return int(self.ctx.current_ts - self.last_event_ts)
+        return int(self.ctx.clock.monotonic() - self.last_event_ts)
 
     def able_to_edit_metadata(self, target):
         """True if we're able to edit metadata on the given target, False otherwise."""
@@ -153,6 +210,20 @@ class ClientProtocol(asyncio.Protocol):
             # XXX - hook up channel ACL when we have that
             return False
 
+    @property
+    def sendq_limit(self):
+        if self.role and self.role.sendq_limit:
+            return self.role.sendq_limit
+        return self.ctx.sendq_limit
+
+    def pause_writing(self):
+        """The transport's buffer is full, so hold lines in our sendq until it drains."""
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.flush_sendq()
+
     def connection_lost(self, exc):
         """Handle loss of connection if it was already not handled.
         Calling quit() can cause this function to be called recursively, so we use IClient.connected
@@ -199,40 +270,62 @@ class ClientProtocol(asyncio.Protocol):
         self.release_registration_lock('DNS')
 
     def data_received(self, data):
-        self.recv_buffer += data
-        recvd = self.recv_buffer.replace(b'\r', b'').split(b'\n')
-        self.recv_buffer = recvd.pop(-1)
+        [self.message_received(m) for m in self.framer.feed(data)]
 
-        linelen = self.ctx.conf.limits.get('line', None)
-        if linelen and len(self.recv_buffer) > linelen:
-            self.recv_buffer = self.recv_buffer[:linelen]
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer(sizehint)
 
-        [self.message_received(m) for m in recvd]
+    def buffer_updated(self, nbytes):
+        [self.message_received(m) for m in self.framer.buffer_updated(nbytes)]
 
     def message_received(self, data):
-        data = data.decode('UTF-8', 'replace').strip('\r\n')
+        if not self.connected:
+            return
 
-        linelen = self.ctx.conf.limits.get('line', None)
-        if linelen and len(data) > linelen:
-            data = data[:linelen]
+        # the framer has already enforced the line length limit
+        data = data.decode('UTF-8', 'replace').strip('\r\n')
 
         m = RFC1459Message.from_message(data)
         m.client = self
 
         # logging.debug('client {0} --> {1}'.format(repr(self.__dict__), repr(m.serialize())))
-        if len(self.recvq) > self.ctx.conf.recvq_len:
-            self.quit('Excess flood')
-            return
-
         self.recvq.append(m)
 
-        # XXX - drain_queue should be called on all objects at once to enforce recvq limits
-        self.drain_queue()
+        # stop reading from the socket until the recvq has drained
+        if len(self.recvq) >= self.ctx.conf.recvq_len and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+        self.ctx.recvq_scheduler.schedule(self)
 
-    def drain_queue(self):
-        while self.recvq:
-            m = self.recvq.pop(0)
-            self.eventmgr.dispatch(*m.to_event())
+    def drain_queue(self, limit=None):
+        """Dispatch up to limit lines from the recvq, for as long as the flood bucket allows."""
+        processed = 0
+        try:
+            while self.recvq and self.connected:
+                if limit is not None and processed >= limit:
+                    break
+
+                now = self.ctx.clock.monotonic()
+                if not self.flood.ready(now):
+                    break
+
+                m = self.recvq.popleft()
+                event, ev_msg = m.to_event()
+                self.flood.consume(self.eventmgr.cost(ev_msg['verb']), now)
+
+                lines_sent = self.lines_sent
+                self.eventmgr.dispatch(event, ev_msg)
+                processed += 1
+
+                # commands producing a lot of output cost extra
+                output_cost = (self.lines_sent - lines_sent) // self.ctx.flood_output_lines
+                if output_cost:
+                    self.flood.consume(output_cost, now)
+        finally:
+            if self.reading_paused and self.connected and len(self.recvq) < self.ctx.conf.recvq_len:
+                self.reading_paused = False
+                self.transport.resume_reading()
 
     # handle a mandatory side effect resulting from rfc1459.
     def handle_side_effect(self, msg, params=[]):
@@ -244,8 +337,13 @@ class ClientProtocol(asyncio.Protocol):
         # XXX - so dump_message works, we don't actually need to return a deep copy
         return self
 
-    def dump_message(self, m):
-        """Dumps an RFC1459 format message to the socket.
+    @property
+    def message_variant(self):
+        """A key identifying which rendering of a message this client receives."""
+        return tuple(cap in self.caps for cap in message_variant_caps)
+
+    def render_message(self, m):
+        """Renders an RFC1459 format message into the bytes this client should receive.
         Side effect: we actually operate on a copy of the message, because the message may have different optional
         mutations depending on capabilities and broadcast target."""
         out_m = copy.deepcopy(m)
@@ -269,7 +367,69 @@ class ClientProtocol(asyncio.Protocol):
             self.ctx.logger.warning('message to {} truncated to {} bytes'.format(self.nickname, linelen))
             message = message[:linelen - 2]
 
-        self.transport.write(bytes(message + '\r\n', 'UTF-8'))
+        return bytes(message + '\r\n', 'UTF-8')
+
+    def dump_message(self, m, cache=None):
+        """Dumps an RFC1459 format message to the socket.
+        If a cache dict is given, the rendered bytes are shared with every other client
+        that is sent the same message with the same cache and has the same message variant."""
+        if cache is None:
+            self.dump_raw(self.render_message(m))
+            return
+
+        variant = self.message_variant
+        data = cache.get(variant, None)
+        if data is None:
+            data = cache[variant] = self.render_message(m)
+        self.dump_raw(data)
+
+    def dump_raw(self, data):
+        """Queues already-rendered bytes for the socket.
+        The sendq is written out once per event loop iteration, or straight away if it
+        grows past the flush threshold, so a burst of lines becomes a single write."""
+        if not self.connected or self.sendq_exceeded:
+            return
+
+        self.sendq.append(data)
+        self.sendq_len += len(data)
+        self.lines_sent += 1
+
+        if self.sendq_bytes > self.sendq_limit:
+            self.excess_sendq()
+        elif self.sendq_len >= self.ctx.sendq_flush_threshold:
+            self.flush_sendq()
+        elif not self.sendq_flush_pending:
+            self.sendq_flush_pending = True
+            self.ctx.eventloop.call_soon(self.flush_sendq)
+
+    def flush_sendq(self):
+        """Writes everything in the sendq to the transport."""
+        self.sendq_flush_pending = False
+        if not self.sendq or not self.connected or self.writing_paused:
+            return
+
+        data = b''.join(self.sendq)
+        self.sendq = list()
+        self.sendq_len = 0
+        self.transport.write(data)
+
+    def excess_sendq(self):
+        """Drop a client that is not reading fast enough to keep its sendq under the limit.
+        The quit is deferred, so callers fanning out a message are not re-entered."""
+        self.ctx.logger.info('client {} exceeded sendq limit of {} bytes'.format(self.nickname, self.sendq_limit))
+        self.sendq_exceeded = True
+        self.sendq = list()
+        self.sendq_len = 0
+        self.ctx.eventloop.call_soon(self.handle_excess_sendq)
+
+    def handle_excess_sendq(self):
+        if self.connected:
+            self.quit('Excess SendQ')
+
+    @property
+    def sendq_bytes(self):
+        """Bytes waiting to be sent to this client, including those buffered by the transport."""
+        return self.sendq_len + self.transport.get_write_buffer_size()
 
     def dump_numeric(self, numeric, params, add_target=True):
         """Dump a numeric to a connected client.
@@ -336,18 +496,27 @@ class ClientProtocol(asyncio.Protocol):
         self.exit()
 
     def exit(self):
-        if self.ping_future:
-            self.ping_future.cancel()
-        if self.ping_timeout_future:
-            self.ping_timeout_future.cancel()
+        self.ctx.timers.cancel(self.dump_ping)
+        self.ctx.timers.cancel(self.ping_timeout_handler)
 
+        self.recvq.clear()
         self.connected = False
-        self.transport.close()
+        if self.sendq_exceeded:
+            # whatever the transport still holds will never be read
+            self.transport.abort()
+        else:
+            # write out the sendq even if writing is paused, so the final
+            # ERROR or QUIT goes out; close() sends the transport's buffer first
+            if self.sendq:
+                self.transport.write(b''.join(self.sendq))
+            self.sendq = list()
+            self.sendq_len = 0
+            self.transport.close()
         if not self.registered:
             return
         while self.channels:
-            i = self.channels.pop(0)
-            i.channel.part(self)
+            ch, m = self.channels.popitem(last=False)
+            ch.part(self)
         self.ctx.clients.pop(self.nickname)
         ClientHistoryEntry(self).register()
 
@@ -414,19 +583,32 @@ class ClientProtocol(asyncio.Protocol):
         msg = RFC1459Message.from_data('MODE', source=self, params=[self.nickname, out])
         self.dump_message(msg)
 
-    def get_common_peers(self, exclude=[], cap=None):
+    @property
+    def common_peers(self):
+        """The set of clients sharing a channel with us, including ourselves.
+        The set is cached until one of our channels gains or loses a member."""
+        key = tuple(ch.generation for ch in self.channels)
+        if key != self._common_peers_key:
+            self._common_peers = frozenset([self]).union(*(ch.members for ch in self.channels))
+            self._common_peers_key = key
+        return self._common_peers
+
+    def get_common_peers(self, exclude=(), cap=None):
         if cap:
-            base = [i.client for m in self.channels for i in m.channel.members if i.client not in exclude and cap in i.client.caps] + [self] if cap in self.caps else []
+            cap_key = cap.casefold()
+            peers = frozenset().union(*(ch.cap_members.get(cap_key, ()) for ch in self.channels))
+            if cap in self.caps:
+                peers |= {self}
         else:
-            base = [i.client for m in self.channels for i in m.channel.members if i.client not in exclude] + [self]
-        peerlist = uniq(base)
-        if self in exclude and self in peerlist:
-            peerlist.remove(self)
-        return peerlist
+            peers = self.common_peers
+        if exclude:
+            peers = peers.difference(exclude)
+        return peers
 
     def sendto_common_peers(self, message, **kwargs):
         peerlist = self.get_common_peers(**kwargs)
-        [i.dump_message(message) for i in peerlist]
+        cache = dict()
+        [i.dump_message(message, cache=cache) for i in peerlist]
 
     def numericto_common_peers(self, numeric, params, add_target=True, **kwargs):
         peerlist = self.get_common_peers(**kwargs)
@@ -450,6 +632,12 @@ class ClientProtocol(asyncio.Protocol):
         self.dump_numeric('005', [format_token(k, v) for k, v in isupport_tokens.items()] + ['are supported by this server'])
 
     def register(self):
+        kline = self.ctx.xlines.find_kline(self.username, self.hostname, self.realaddr)
+        if kline:
+            self.dump_numeric('465', ['You are banned from this server: {}'.format(kline['reason'])])
+            self.quit('K-Lined')
+            return
+
         self.registered = True
         self.ctx.clients[self.nickname] = self
 
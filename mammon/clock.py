@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import time
+
+class Clock(object):
+    """Wall clock and monotonic time, at millisecond precision.
+    ISO-8601 timestamps, as used by server-time, are formatted at most once
+    per millisecond, so a message fanned out to many clients reuses one string."""
+    def __init__(self):
+        self._iso_second = None
+        self._iso_prefix = None
+        self._iso_ms = None
+        self._iso = None
+
+    def wall(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def isotime(self, ts=None):
+        """Returns ts, or the current time, formatted as an ISO-8601 UTC timestamp."""
+        if ts is None:
+            ts = time.time()
+
+        ms = int(ts * 1000)
+        if ms != self._iso_ms:
+            second, millisecond = divmod(ms, 1000)
+            if second != self._iso_second:
+                self._iso_second = second
+                self._iso_prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._iso_ms = ms
+            self._iso = '{}.{:03d}Z'.format(self._iso_prefix, millisecond)
+
+        return self._iso
@@ -34,6 +34,8 @@ def load_extended_roles(ctx, k, roles, roles_extending):
 class ConfigHandler(object):
     config_st = {}
     ctx = None
+    flood = {}
+    hashing = {}
     listener_protos = {
         'client': ClientProtocol,
     }
@@ -88,6 +90,12 @@ class ConfigHandler(object):
 
                 context.load_cert_chain(certfile, keyfile=keyfile)
 
+                # ask for client certificates signed by this CA, for SASL EXTERNAL
+                client_ca = os.path.expanduser(l.get('client_ca', ''))
+                if client_ca:
+                    context.verify_mode = ssl.CERT_OPTIONAL
+                    context.load_verify_locations(cafile=client_ca)
+
                 # disable old protocols
                 context.options |= ssl.OP_NO_SSLv2
                 context.options |= ssl.OP_NO_SSLv3
@@ -219,7 +219,7 @@ metadata_cmds = {
 }
 metadata_cmds = CaseInsensitiveDict(**metadata_cmds)
 
-@eventmgr_rfc1459.message('METADATA', min_params=2)
+@eventmgr_rfc1459.message('METADATA', min_params=2, cost=2)
 def m_METADATA(cli, ev_msg):
     target_name, subcmd = ev_msg['params'][:2]
 
@@ -263,8 +263,8 @@ def set_key(target, key, value=None):
         target.metadata[key] = value
 
 def get_monitor_list(source, target):
-    monitor_list = monitor.monitored.get(target.nickname, [])
-    monitor_list += target.get_common_peers(exclude=monitor_list+[source], cap='metadata-notify')
+    monitor_list = set(monitor.monitored.get(target.nickname, ()))
+    monitor_list |= target.get_common_peers(exclude=[source], cap='metadata-notify')
     return monitor_list
 
 def dump_metadata_notify(source, target, key, args, monitor_list=None, restricted_keys=None):
@@ -16,6 +16,7 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 from ircreactor.envelope import RFC1459Message
+import asyncio
 import ircmatch
 
 from mammon import __credits__, __version__
@@ -26,6 +27,8 @@ from mammon.server import get_context
 # - - - BUILTIN RFC1459 EVENTS - - -
 
 from . import away
+from . import stats
+from . import xline
 
 @eventmgr_rfc1459.message('KILL', min_params=2)
 def m_KILL(cli, ev_msg):
@@ -68,15 +71,15 @@ def m_OPER(cli, ev_msg):
             return
 
     data = cli.ctx.conf.opers.get(name, None)
+    pass_is_valid = False
     if data is not None:
-        pass_is_valid = False
-
         hash = data.get('hash', None)
         if hash:
             if hash not in cli.ctx.hashing.valid_schemes:
                 print('mammon: error: hashing algorithm for oper password is not valid')
             elif cli.ctx.hashing.enabled:
-                pass_is_valid = cli.ctx.hashing.verify(password, data.get('password'))
+                asyncio.async(do_oper_hashed(cli, name, data, password))
+                return
             else:
                 print('mammon: error: cannot verify oper password, hashing is not enabled')
         else:
@@ -84,6 +87,22 @@ def m_OPER(cli, ev_msg):
 
         del password
 
+    oper_up(cli, name, data, pass_is_valid)
+
+def do_oper_hashed(cli, name, data, password):
+    """Verify a hashed oper password off the event loop, as a coroutine."""
+    pass_is_valid = yield from cli.ctx.hashing.verify_async(password, data.get('password'))
+    del password
+
+    # oper passwords live in the config file, so we can't rehash them ourselves
+    if pass_is_valid and cli.ctx.hashing.needs_update(data.get('password')):
+        cli.ctx.logger.info('password hash for oper {} is weaker than the hashing settings, regenerate it with:  mammond --mkpasswd'.format(name))
+
+    if cli.connected:
+        oper_up(cli, name, data, pass_is_valid)
+
+def oper_up(cli, name, data, pass_is_valid):
+    if data is not None:
         # check this specific oper's hostmask
         hostmask = data.get('hostmask')
         if not ircmatch.match(0, hostmask, cli.hostmask):
@@ -124,6 +143,8 @@ def m_NICK(cli, ev_msg):
     if cli.registered:
         msg = RFC1459Message.from_data('NICK', source=cli, params=[new_nickname])
         cli.sendto_common_peers(msg)
+    for ch in cli.channels:
+        ch.rename_member(cli.nickname, new_nickname)
     cli.nickname = new_nickname
     cli.release_registration_lock('NICK')
 
@@ -157,7 +178,7 @@ def m_PONG(cli, ev_msg):
     cli.last_pong = cli.ctx.current_ts
     cli.update_pings()
 
-@eventmgr_rfc1459.message('INFO')
+@eventmgr_rfc1459.message('INFO', cost=2)
 def m_INFO(cli, ev_msg):
     lines = __credits__.splitlines()
     for line in lines:
@@ -238,7 +259,7 @@ def m_NOTICE(cli, ev_msg):
         msg = RFC1459Message.from_data('NOTICE', source=cli, params=[ch.name, message])
         ch.dump_message(msg, exclusion_list=[cli])
 
-@eventmgr_rfc1459.message('MOTD')
+@eventmgr_rfc1459.message('MOTD', cost=2)
 def m_MOTD(cli, ev_msg):
     if cli.ctx.conf.motd:
         cli.dump_numeric('375', ['- ' + cli.ctx.conf.name + ' Message of the Day -'])
@@ -301,7 +322,7 @@ def m_ISON(cli, ev_msg):
 
 # WHO 0 o
 # WHO #channel
-@eventmgr_rfc1459.message('WHO', min_params=1)
+@eventmgr_rfc1459.message('WHO', min_params=1, cost=3)
 def m_WHO(cli, ev_msg):
     oper_query = False
     if len(ev_msg['params']) > 1:
@@ -318,7 +339,7 @@ def m_WHO(cli, ev_msg):
     if target[0] == '#':
         chan = cli.ctx.chmgr.get(target)
         if chan:
-            [do_single_who(cli, target, i.client, i.who_status) for i in chan.members]
+            [do_single_who(cli, target, i.client, i.who_status) for i in chan.members.values()]
     else:
         u = cli.ctx.clients.get(target, None)
         if u:
@@ -327,7 +348,7 @@ def m_WHO(cli, ev_msg):
     cli.dump_numeric('315', [target, 'End of /WHO list.'])
 
 # WHOIS nickname
-@eventmgr_rfc1459.message('WHOIS', min_params=1)
+@eventmgr_rfc1459.message('WHOIS', min_params=1, cost=2)
 def m_WHOIS(cli, ev_msg):
     target = ev_msg['params'][0]
 
@@ -336,7 +357,7 @@ def m_WHOIS(cli, ev_msg):
         cli.dump_numeric('401', [target, 'No such nick/channel'])
         return
 
-    channels = tuple(filter(lambda x: 'secret' not in x.channel.props or x.channel.has_member(cli), cli_tg.channels))
+    channels = tuple(filter(lambda x: 'secret' not in x.channel.props or x.channel.has_member(cli), cli_tg.channels.values()))
 
     cli.dump_numeric('311', [cli_tg.nickname, cli_tg.username, cli_tg.hostname, '*', cli_tg.realname])
     if channels:
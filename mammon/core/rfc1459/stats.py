@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+from mammon.server import eventmgr_rfc1459
+
+# STATS letter -> function(cli) that dumps the report lines
+stats_handlers = dict()
+
+def stats_query(letter):
+    def parent_fn(func):
+        stats_handlers[letter] = func
+        return func
+    return parent_fn
+
+@eventmgr_rfc1459.message('STATS', min_params=1)
+def m_STATS(cli, ev_msg):
+    letter = ev_msg['params'][0][:1]
+
+    if not cli.props.get('special:oper', False):
+        cli.dump_numeric('481', ['Permission Denied'])
+        return
+
+    handler = stats_handlers.get(letter, None)
+    if handler:
+        handler(cli)
+
+    cli.dump_numeric('219', [letter, 'End of /STATS report'])
+
+@stats_query('q')
+def stats_queues(cli):
+    sendq_total = 0
+    for client in cli.ctx.clients.values():
+        if client.servername != cli.ctx.conf.name:
+            continue
+
+        sendq_total += client.sendq_bytes
+        flags = ''
+        if client.reading_paused:
+            flags += 'r'
+        if client.writing_paused:
+            flags += 'w'
+
+        cli.dump_numeric('249', ['q {} sendq {}/{} recvq {}/{} flood {:.1f}/{} paused [{}]'.format(
+            client.nickname, client.sendq_bytes, client.sendq_limit,
+            len(client.recvq), cli.ctx.conf.recvq_len,
+            client.flood.tokens, client.flood.burst, flags)])
+
+    cli.dump_numeric('249', ['q total sendq {}'.format(sendq_total)])
+
+@stats_query('z')
+def stats_datastore(cli):
+    data = cli.ctx.data
+    cli.dump_numeric('249', ['z data store format {}'.format(data.format)])
+
+    stats = getattr(data, 'snapshot_stats', None)
+    if stats:
+        cli.dump_numeric('249', ['z snapshots {count} overlapped {overlaps} last {last_duration:.3f}s {last_size} bytes slowest {max_duration:.3f}s'.format(**stats)])
+    elif data.format == 'sqlite':
+        cli.dump_numeric('249', ['z cache {}/{} uncommitted writes {}'.format(len(data._cache), data._cache_size, len(data._pending))])
+
+@stats_query('h')
+def stats_hashing(cli):
+    hashing = cli.ctx.hashing
+    cli.dump_numeric('249', ['h hashing workers {}'.format(hashing.workers or 'threads')])
+
+    cache = hashing.verified_cache
+    if cache is not None:
+        cli.dump_numeric('249', ['h verified cache {}/{} hits {} misses {}'.format(
+            len(cache), cache.max_entries, cache.hits, cache.misses)])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+from mammon.server import eventmgr_rfc1459
+from .stats import stats_query
+
+def has_capability(cli, capability):
+    if (cli.role and capability not in cli.role.capabilities) or not cli.role:
+        cli.dump_numeric('481', ['Permission Denied'])
+        return False
+    return True
+
+def parse_xline(params):
+    """Splits [minutes] <target> [reason] into (seconds, target, reason), or None."""
+    params = list(params)
+    duration = 0
+    if len(params) > 1 and params[0].isdigit():
+        duration = int(params.pop(0)) * 60
+    if not params:
+        return None
+    reason = params[1] if len(params) > 1 else 'No reason given'
+    return duration, params[0], reason
+
+def describe_duration(entry):
+    if not entry['expires']:
+        return 'permanent'
+    return '{} min'.format((entry['expires'] - entry['set_ts']) // 60)
+
+def drop_banned_clients(ctx, find, message):
+    for client in list(ctx.clients.values()):
+        if client.servername != ctx.conf.name:
+            continue
+        entry = find(client)
+        if entry:
+            client.dump_numeric('465', ['You are banned from this server: {}'.format(entry['reason'])])
+            client.quit(message)
+
+@eventmgr_rfc1459.message('KLINE', min_params=1)
+def m_KLINE(cli, ev_msg):
+    if not has_capability(cli, 'oper:kline'):
+        return
+
+    parsed = parse_xline(ev_msg['params'])
+    if not parsed:
+        cli.dump_numeric('461', ['KLINE', 'Not enough parameters'])
+        return
+    duration, mask, reason = parsed
+
+    if '@' not in mask:
+        target = cli.ctx.clients.get(mask, None)
+        if not target:
+            cli.dump_numeric('401', [mask, 'No such nick/channel'])
+            return
+        mask = '*@{}'.format(target.realaddr)
+    elif '!' in mask or ' ' in mask:
+        cli.dump_notice('Invalid K-line mask {}'.format(mask))
+        return
+
+    xlines = cli.ctx.xlines
+    entry = xlines.add_kline(mask, reason, duration, cli.hostmask)
+    cli.dump_notice('Added {} K-line for [{}]'.format(describe_duration(entry), entry['mask']))
+
+    drop_banned_clients(cli.ctx, lambda c: xlines.find_kline(c.username, c.hostname, c.realaddr), 'K-Lined')
+
+@eventmgr_rfc1459.message('UNKLINE', min_params=1)
+def m_UNKLINE(cli, ev_msg):
+    if not has_capability(cli, 'oper:unkline'):
+        return
+
+    mask = ev_msg['params'][0]
+    if cli.ctx.xlines.remove_kline(mask):
+        cli.dump_notice('K-line for [{}] is removed'.format(mask))
+    else:
+        cli.dump_notice('No K-line for {}'.format(mask))
+
+@eventmgr_rfc1459.message('DLINE', min_params=1)
+def m_DLINE(cli, ev_msg):
+    if not has_capability(cli, 'oper:kline'):
+        return
+
+    parsed = parse_xline(ev_msg['params'])
+    if not parsed:
+        cli.dump_numeric('461', ['DLINE', 'Not enough parameters'])
+        return
+    duration, network, reason = parsed
+
+    xlines = cli.ctx.xlines
+    try:
+        entry = xlines.add_dline(network, reason, duration, cli.hostmask)
+    except ValueError:
+        cli.dump_notice('Invalid D-line address {}'.format(network))
+        return
+    cli.dump_notice('Added {} D-line for [{}]'.format(describe_duration(entry), entry['mask']))
+
+    drop_banned_clients(cli.ctx, lambda c: xlines.find_dline(c.realaddr), 'D-Lined')
+
+@eventmgr_rfc1459.message('UNDLINE', min_params=1)
+def m_UNDLINE(cli, ev_msg):
+    if not has_capability(cli, 'oper:unkline'):
+        return
+
+    network = ev_msg['params'][0]
+    if cli.ctx.xlines.remove_dline(network):
+        cli.dump_notice('D-line for [{}] is removed'.format(network))
+    else:
+        cli.dump_notice('No D-line for {}'.format(network))
+
+@stats_query('k')
+def stats_klines(cli):
+    for entry in cli.ctx.xlines.kline_entries.values():
+        username, _, hostname = entry['mask'].partition('@')
+        cli.dump_numeric('216', ['K', hostname, '*', username, '{} ({}, set by {})'.format(
+            entry['reason'], describe_duration(entry), entry['set_by'])])
+
+@stats_query('d')
+def stats_dlines(cli):
+    store = cli.ctx.xlines.dline_store
+    for network in store:
+        entry = store.get(network)
+        cli.dump_numeric('225', ['D', entry['mask'], '{} ({}, set by {})'.format(
+            entry['reason'], describe_duration(entry), entry['set_by'])])
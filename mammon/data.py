@@ -15,94 +15,856 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+import collections
 import json
+import mmap
 import os
+import queue
+import shutil
+import sqlite3
+import struct
+import sys
 import threading
+import time
+import zlib
 
 from .server import get_context
 
+# formats that keep the whole store in memory
+memory_formats = ('json', 'journal')
+
+def interned_dict(pairs):
+    return {sys.intern(key): value for key, value in pairs}
+
+# values are decoded one at a time when a snapshot is loaded, which loses json's
+# sharing of repeated object keys between them, so intern those instead
+decode_value = json.JSONDecoder(object_pairs_hook=interned_dict).decode
+
+# binary snapshots are the magic, then one record per key.  each record is
+# a header of payload length and crc32, then a payload of the key length,
+# the utf-8 key and the json encoded value
+binary_magic = b'MAMMON\x00\x01'
+binary_header = struct.Struct('>II')
+binary_keylen = struct.Struct('>H')
+
+def write_binary_snapshot(store_file, items):
+    """Writes (key, encoded value) pairs to store_file as a binary snapshot."""
+    store_file.write(binary_magic)
+    for key, value in items:
+        key = key.encode('utf-8')
+        payload = binary_keylen.pack(len(key)) + key + value.encode('utf-8')
+        store_file.write(binary_header.pack(len(payload), zlib.crc32(payload)))
+        store_file.write(payload)
+
+def read_binary_snapshot(filename, use_mmap=False):
+    """Yields (key, encoded value) pairs from a binary snapshot, one record at a time."""
+    with open(filename, 'rb') as store_file:
+        if use_mmap and os.path.getsize(filename):
+            view = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+            read = None
+        else:
+            view = None
+            read = store_file.read
+
+        offset = len(binary_magic)
+        magic = read(offset) if read else view[:offset]
+        if magic != binary_magic:
+            raise Exception('{} is not a binary data store snapshot'.format(filename))
+
+        try:
+            while True:
+                if read:
+                    header = read(binary_header.size)
+                else:
+                    header = view[offset:offset + binary_header.size]
+                if not header:
+                    break
+                if len(header) != binary_header.size:
+                    raise Exception('data store snapshot {} is truncated at offset {}'.format(filename, offset))
+                length, crc = binary_header.unpack(header)
+                offset += binary_header.size
+
+                payload = read(length) if read else view[offset:offset + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    raise Exception('data store snapshot {} is damaged at offset {}'.format(filename, offset))
+                offset += length
+
+                keylen = binary_keylen.unpack_from(payload)[0]
+                key_end = binary_keylen.size + keylen
+                yield payload[binary_keylen.size:key_end].decode('utf-8'), payload[key_end:].decode('utf-8')
+        finally:
+            if view is not None:
+                view.close()
+
+def write_json_snapshot(store_file, items):
+    """Writes (key, encoded value) pairs to store_file as a json object, one key per
+    line, so it can be read back a line at a time."""
+    store_file.write('{')
+    separator = '\n'
+    for key, value in items:
+        store_file.write(separator + json.dumps(key) + ':' + value)
+        separator = ',\n'
+    store_file.write('\n}')
+
+def read_json_snapshot(filename):
+    """Yields (key, encoded value) pairs from a json snapshot.  Snapshots written by
+    write_json_snapshot are read a line at a time, anything else is loaded whole."""
+    with open(filename, 'r') as store_file:
+        if store_file.readline() != '{\n':
+            store_file.seek(0)
+            for key, value in json.load(store_file).items():
+                yield key, json.dumps(value)
+            return
+
+        decoder = json.JSONDecoder()
+        for line in store_file:
+            line = line.rstrip('\n')
+            if line == '}':
+                break
+            if line.endswith(','):
+                line = line[:-1]
+            # the key, then a colon, then the value
+            key, end = decoder.raw_decode(line)
+            yield key, line[end + 1:]
+
+def read_snapshot(filename, use_mmap=False):
+    """Yields (key, encoded value) pairs from a snapshot in either format."""
+    if is_binary_snapshot(filename):
+        return read_binary_snapshot(filename, use_mmap)
+    return read_json_snapshot(filename)
+
+def is_binary_snapshot(filename):
+    with open(filename, 'rb') as store_file:
+        return store_file.read(len(binary_magic)) == binary_magic
+
+def convert_snapshot(source, destination):
+    """Converts a json data store snapshot into a binary one.  Returns the number of keys."""
+    with open(source, 'r') as store_file:
+        store = json.load(store_file)
+
+    tmp_destination = destination + '.tmp'
+    with open(tmp_destination, 'wb') as store_file:
+        write_binary_snapshot(store_file, ((key, json.dumps(value)) for key, value in store.items()))
+        store_file.flush()
+        os.fsync(store_file.fileno())
+    os.rename(tmp_destination, destination)
+
+    return len(store)
+
+def prefix_upper(prefix):
+    """Returns the first string after every string starting with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def index_value(value, field):
+    """Returns the encoded value of field for the sqlite index, or None if it isn't indexable."""
+    if not isinstance(value, dict) or field not in value:
+        return None
+    value = value[field]
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        # lists and dicts can't be indexed
+        return None
+    return json.dumps(value)
+
+class Collection:
+    """The keys in the data store sharing a prefix, such as accounts.
+
+    Names are the keys without the prefix, kept sorted for prefix scans.
+    Indexed fields of the (dict) values map each value to the names that have
+    it, and are kept up to date on every put and delete through the store."""
+    def __init__(self, store, name, prefix):
+        self.store = store
+        self.name = name
+        self.prefix = prefix
+        self._names = sorted(key[len(prefix):] for key in store.list_keys(prefix))
+
+        # field -> {value: set of names}, and field -> {name: indexed value}
+        self._indexes = {}
+        self._indexed = {}
+
+    def __contains__(self, name):
+        return self.prefix + name in self.store
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def get(self, name, default=None):
+        return self.store.get(self.prefix + name, default)
+
+    def put(self, name, value):
+        return self.store.put(self.prefix + name, value)
+
+    def delete(self, name):
+        return self.store.delete(self.prefix + name)
+
+    def names(self, prefix=''):
+        """Return the names starting with prefix, in sorted order."""
+        if not prefix:
+            return list(self._names)
+        start = bisect_left(self._names, prefix)
+        upper = prefix_upper(prefix)
+        return self._names[start:bisect_left(self._names, upper, start)]
+
+    def find(self, field, value):
+        """Return the names whose field is value.  field must be indexed."""
+        try:
+            return set(self._indexes[field].get(value, ()))
+        except KeyError:
+            raise Exception('Field [{}] is not indexed in collection [{}]'.format(field, self.name))
+
+    def values(self, field):
+        """Return the distinct values of an indexed field."""
+        return list(self._indexes[field])
+
+    def add_index(self, field):
+        if field in self._indexes:
+            return
+        self._indexes[field] = {}
+        self._indexed[field] = {}
+        for name in self._names:
+            self._index(field, name, self.get(name))
+
+    def _index(self, field, name, value):
+        index = self._indexes[field]
+        indexed = self._indexed[field]
+
+        if name in indexed:
+            old = indexed.pop(name)
+            names = index[old]
+            names.discard(name)
+            if not names:
+                del index[old]
+
+        if not isinstance(value, dict) or field not in value:
+            return
+        value = value[field]
+        try:
+            index.setdefault(value, set()).add(name)
+        except TypeError:
+            # lists and dicts can't be indexed
+            return
+        indexed[name] = value
+
+    def _updated(self, key, value):
+        name = key[len(self.prefix):]
+        i = bisect_left(self._names, name)
+        if i == len(self._names) or self._names[i] != name:
+            self._names.insert(i, name)
+        for field in self._indexes:
+            self._index(field, name, value)
+
+    def _deleted(self, key):
+        name = key[len(self.prefix):]
+        i = bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            del self._names[i]
+        for field in self._indexes:
+            self._index(field, name, None)
+
+class SqliteCollection(Collection):
+    """A collection in the sqlite data store.  Nothing is held in memory: names
+    are range queries on the primary key, and indexes live in the kv_index table,
+    which the writer thread keeps up to date in the same transaction as the
+    writes.  An index is built by the writer the first time it's declared, and
+    queries on it scan the collection until that has finished.  Writes not yet
+    committed are merged into every result."""
+    def __init__(self, store, name, prefix):
+        self.store = store
+        self.name = name
+        self.prefix = prefix
+        self.upper = prefix_upper(prefix)
+
+        # field -> threading.Event set once the writer has built the index
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.names())
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def _pending(self):
+        """Returns (key, encoded value or None) for uncommitted writes in this collection.
+        Taken before querying, so a write committed in between is seen by the query."""
+        with self.store._store_lock:
+            return [(key, encoded) for key, (seq, encoded) in self.store._pending.items()
+                    if self.prefix <= key < self.upper]
+
+    def names(self, prefix=''):
+        """Return the names starting with prefix, in sorted order."""
+        start = self.prefix + prefix
+        upper = prefix_upper(start)
+
+        pending = self._pending()
+        rows = self.store._db.execute('SELECT key FROM kv WHERE key >= ? AND key < ?', (start, upper))
+        keys = set(row[0] for row in rows)
+
+        for key, encoded in pending:
+            if not key.startswith(start):
+                continue
+            if encoded is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+
+        return sorted(key[len(self.prefix):] for key in keys)
+
+    def _committed(self, field, encoded_value=None):
+        """Returns {key: encoded value of field} for committed entries, only those
+        where it's encoded_value if that's given.  Until the writer has built the
+        index this scans the collection instead, as waiting would block the loop."""
+        try:
+            built = self._indexes[field]
+        except KeyError:
+            raise Exception('Field [{}] is not indexed in collection [{}]'.format(field, self.name))
+
+        if built.is_set():
+            if encoded_value is None:
+                rows = self.store._db.execute('SELECT key, value FROM kv_index WHERE field = ? AND key >= ? AND key < ?',
+                                              (field, self.prefix, self.upper))
+            else:
+                rows = self.store._db.execute('SELECT key, value FROM kv_index WHERE field = ? AND value = ? AND key >= ? AND key < ?',
+                                              (field, encoded_value, self.prefix, self.upper))
+            return dict(rows)
+
+        found = {}
+        rows = self.store._db.execute('SELECT key, value FROM kv WHERE key >= ? AND key < ?', (self.prefix, self.upper))
+        for key, encoded in rows:
+            key_value = index_value(json.loads(encoded), field)
+            if key_value is not None and encoded_value in (None, key_value):
+                found[key] = key_value
+        return found
+
+    def find(self, field, value):
+        """Return the names whose field is value.  field must be indexed."""
+        encoded_value = json.dumps(value)
+
+        pending = self._pending()
+        keys = set(self._committed(field, encoded_value))
+
+        for key, encoded in pending:
+            if encoded is not None and index_value(json.loads(encoded), field) == encoded_value:
+                keys.add(key)
+            else:
+                keys.discard(key)
+
+        return set(key[len(self.prefix):] for key in keys)
+
+    def values(self, field):
+        """Return the distinct values of an indexed field."""
+        pending = self._pending()
+        values = self._committed(field)
+
+        for key, encoded in pending:
+            values.pop(key, None)
+            if encoded is not None:
+                encoded_value = index_value(json.loads(encoded), field)
+                if encoded_value is not None:
+                    values[key] = encoded_value
+
+        return [json.loads(value) for value in set(values.values())]
+
+    def add_index(self, field):
+        if field in self._indexes:
+            return
+        built = self._indexes[field] = threading.Event()
+        self.store._write_queue.put(('index', self.prefix, field, built))
+
+    def _updated(self, key, value):
+        pass
+
+    def _deleted(self, key):
+        pass
+
 class DataStore:
+    """Persistent key/value storage for accounts and other network state.
+
+    The json format writes a snapshot of the whole store every save_frequency.
+    The journal format appends every put and delete to a journal, flushed to
+    disk every sync_frequency, and also writes a snapshot every save_frequency,
+    starting a new journal.  On startup the snapshot is loaded and the journal
+    replayed over it.
+
+    Snapshots are written by a worker thread, which streams the previous
+    snapshot into the new one, replacing the keys changed since.  The event
+    loop only hands it those keys, as encoded when they were put, so neither
+    side keeps a second copy of the store.
+
+    The sqlite format loads nothing up front.  Reads go through a bounded cache
+    to the database, and writes are committed in batches by a writer thread
+    with its own connection.  Writes not yet committed are kept in a pending
+    map so reads always see them.  Collections are queried in the database too,
+    with their indexes kept by the writer thread.
+
+    Only put() and delete() change what is saved, in every format.  Values
+    returned by get() are the store's own, so change a copy and put() that
+    rather than changing them in place."""
     def create_or_load(self):
         ctx = get_context()
         self.format = ctx.conf.data['format']
+        self.collections = {}
 
         ctx.logger.debug('creating/loading datastore using {}'.format(self.format))
 
-        if self.format == 'json':
+        if self.format in memory_formats:
             self._store = {}
             self._store_lock = threading.Lock()
 
             self._filename = os.path.abspath(os.path.expanduser(ctx.conf.data['filename']))
             self._tmp_filename = self._filename + '.tmp'
 
-            ctx.logger.debug('loading json data store from {}'.format(self._filename))
+            self._save_frequency = timedelta(**ctx.conf.data['save_frequency']).total_seconds()
+            self._snapshot_format = ctx.conf.data.get('snapshot_format', 'json')
+
+            # key -> encoded value, or None if deleted, since the last snapshot
+            self._dirty = {}
+            # changes from a snapshot that failed, for the worker to retry with the next one
+            self._unsaved = {}
 
+            self._use_mmap = ctx.conf.data.get('mmap', False)
             if os.path.exists(self._filename):
-                self._store = json.loads(open(self._filename, 'r').read())
+                # either snapshot format can be loaded, whichever is configured for writing
+                ctx.logger.debug('loading data store from {}'.format(self._filename))
+                for key, value in read_snapshot(self._filename, self._use_mmap):
+                    self._store[key] = decode_value(value)
 
-            self._save_frequency = timedelta(**ctx.conf.data['save_frequency']).total_seconds()
+            self._snapshot_future = None
+            self._snapshot_started = None
+            self.snapshot_stats = {
+                'count': 0,
+                'overlaps': 0,
+                'last_duration': 0.0,
+                'max_duration': 0.0,
+                'last_size': 0,
+            }
+
+            # snapshots and journal writes happen on one thread, in order
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        elif self.format == 'sqlite':
+            self._filename = os.path.abspath(os.path.expanduser(ctx.conf.data['filename']))
+
+            ctx.logger.debug('opening sqlite data store {}'.format(self._filename))
+
+            self._db = sqlite3.connect(self._filename)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+            # collection indexes: which fields are indexed for which key prefixes,
+            # and the encoded value of each indexed field for each key
+            self._db.execute('CREATE TABLE IF NOT EXISTS kv_indexes (prefix TEXT NOT NULL, field TEXT NOT NULL, PRIMARY KEY (prefix, field)) WITHOUT ROWID')
+            self._db.execute('CREATE TABLE IF NOT EXISTS kv_index (field TEXT NOT NULL, value TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (field, value, key)) WITHOUT ROWID')
+            self._db.execute('CREATE INDEX IF NOT EXISTS kv_index_key ON kv_index (key)')
+            self._db.commit()
+
+            # decoded values, most recently used last
+            self._cache = collections.OrderedDict()
+            self._cache_size = ctx.conf.data.get('cache_size', 10000)
+
+            # key -> (sequence, encoded value or None for a delete), until committed
+            self._pending = {}
+            self._pending_seq = 0
+            self._store_lock = threading.Lock()
+
+            self._write_queue = queue.Queue()
+            self._writer = threading.Thread(target=self._sqlite_writer, name='datastore writer', daemon=True)
+            self._writer.start()
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
+        if self.format == 'journal':
+            self._journal_filename = self._filename + '.journal'
+            self._old_journal_filename = self._journal_filename + '.old'
+            self._replay_journal(self._old_journal_filename)
+            self._replay_journal(self._journal_filename)
+
+            self._journal = open(self._journal_filename, 'a')
+            if self._journal.tell():
+                # terminate any torn record so new ones start on a fresh line
+                self._journal.write('\n')
+            self._journal_pending = []
+            self._sync_frequency = timedelta(**ctx.conf.data.get('sync_frequency', {'seconds': 1})).total_seconds()
+            ctx.eventloop.call_later(self._sync_frequency, self.sync_callback)
+
     def save_callback(self):
-        if self.format == 'json':
-            self.save()
+        if self.format in memory_formats:
+            self.snapshot()
             ctx = get_context()
             ctx.eventloop.call_later(self._save_frequency, self.save_callback)
 
+    def sync_callback(self):
+        self.sync()
+        ctx = get_context()
+        ctx.eventloop.call_later(self._sync_frequency, self.sync_callback)
+
     def save(self):
         ctx = get_context()
         ctx.logger.debug('saving datastore')
         if self.format == 'json':
-            with open(self._tmp_filename, 'w') as store_file:
-                store_file.write(json.dumps(self._store))
-            os.rename(self._tmp_filename, self._filename)
+            self._submit_snapshot().result()
+        elif self.format == 'journal':
+            # everything is in the journal already, it just needs to hit the disk
+            self.sync().result()
+        elif self.format == 'sqlite':
+            # writes are committed as they come in, wait for the writer to finish up
+            if self._writer.is_alive():
+                self._write_queue.put(None)
+                self._writer.join()
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
+    # journal
+    def _replay_journal(self, filename):
+        if not os.path.exists(filename):
+            return
+
+        ctx = get_context()
+        ctx.logger.debug('replaying data store journal {}'.format(filename))
+
+        with open(filename, 'r') as journal:
+            for line in journal:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn write at the end of the journal, from a crash
+                    ctx.logger.info('ignoring damaged record in data store journal {}'.format(filename))
+                    continue
+
+                op, key = record[:2]
+                if op == 'p':
+                    self._store[key] = record[2]
+                    self._dirty[key] = json.dumps(record[2])
+                elif op == 'd':
+                    self._store.pop(key, None)
+                    self._dirty[key] = None
+                elif op == 'x':
+                    for k in tuple(self._store):
+                        if k.startswith(key):
+                            del self._store[k]
+                            self._dirty[k] = None
+
+    def _journal_append(self, op, key, encoded=None):
+        record = '["{}",{}'.format(op, json.dumps(key))
+        if encoded is not None:
+            record += ',' + encoded
+        self._journal_pending.append(record + ']\n')
+
+    def sync(self):
+        """Writes pending journal records out and fsyncs them, off the event loop.
+        Returns a future that completes once they are on disk."""
+        pending = ''.join(self._journal_pending)
+        self._journal_pending = []
+        return self._executor.submit(self._journal_write, pending)
+
+    def _journal_write(self, data):
+        if not data:
+            return
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    # snapshots
+    def snapshot(self):
+        """Starts writing a snapshot of the store off the event loop, unless the last
+        one is still being written.  Returns a future for the snapshot."""
+        if self._snapshot_future is not None and not self._snapshot_future.done():
+            ctx = get_context()
+            self.snapshot_stats['overlaps'] += 1
+            ctx.logger.warning('data store snapshot still running after {:.1f} seconds, skipping this one'.format(
+                time.monotonic() - self._snapshot_started))
+            return self._snapshot_future
+
+        return self._submit_snapshot()
+
+    def _submit_snapshot(self):
+        dirty = self._dirty
+        self._dirty = {}
+
+        rotate = self.format == 'journal'
+        if rotate:
+            self.sync()
+
+        self._snapshot_future = self._executor.submit(self._write_snapshot, dirty, rotate)
+        return self._snapshot_future
+
+    def _write_snapshot(self, dirty, rotate):
+        ctx = get_context()
+        self._snapshot_started = started = time.monotonic()
+
+        if rotate:
+            # anything written from now on is not part of this snapshot
+            self._journal.close()
+            if os.path.exists(self._old_journal_filename):
+                # left by a snapshot that failed, and still not covered by one
+                with open(self._old_journal_filename, 'a') as old_journal, open(self._journal_filename, 'r') as journal:
+                    shutil.copyfileobj(journal, old_journal)
+                    old_journal.flush()
+                    os.fsync(old_journal.fileno())
+                os.remove(self._journal_filename)
+            else:
+                os.rename(self._journal_filename, self._old_journal_filename)
+            self._journal = open(self._journal_filename, 'a')
+
+        if self._unsaved:
+            self._unsaved.update(dirty)
+            dirty = self._unsaved
+            self._unsaved = {}
+
+        count = 0
+        def items():
+            # the last snapshot with the changed keys left out, then the changed keys
+            nonlocal count
+            if os.path.exists(self._filename):
+                for key, encoded in read_snapshot(self._filename, self._use_mmap):
+                    if key not in dirty:
+                        count += 1
+                        yield key, encoded
+            for key, encoded in dirty.items():
+                if encoded is not None:
+                    count += 1
+                    yield key, encoded
+
+        try:
+            with open(self._tmp_filename, 'wb' if self._snapshot_format == 'binary' else 'w') as store_file:
+                if self._snapshot_format == 'binary':
+                    write_binary_snapshot(store_file, items())
+                else:
+                    write_json_snapshot(store_file, items())
+                store_file.flush()
+                os.fsync(store_file.fileno())
+                size = store_file.tell()
+            os.rename(self._tmp_filename, self._filename)
+        except:
+            # the old snapshot is still in place, so these changes go into the next one
+            self._unsaved = dirty
+            raise
+
+        if rotate:
+            # the snapshot covers the old journal now, a crash before this point
+            # just replays records the snapshot already contains
+            os.remove(self._old_journal_filename)
+
+        duration = time.monotonic() - started
+        stats = self.snapshot_stats
+        stats['count'] += 1
+        stats['last_duration'] = duration
+        stats['max_duration'] = max(stats['max_duration'], duration)
+        stats['last_size'] = size
+
+        ctx.logger.debug('wrote data store snapshot, {} keys, {} bytes in {:.3f} seconds'.format(count, size, duration))
+
+    # sqlite
+    def _sqlite_writer(self):
+        db = sqlite3.connect(self._filename)
+        db.execute('PRAGMA synchronous=NORMAL')
+
+        # prefix -> indexed fields, as recorded in the database, so indexes stay
+        # current even in runs that don't declare them
+        indexed = {}
+        for prefix, field in db.execute('SELECT prefix, field FROM kv_indexes'):
+            indexed.setdefault(prefix, set()).add(field)
+
+        running = True
+        while running:
+            batch = [self._write_queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [write for write in batch if write is not None]
+
+            builds = [write for write in batch if write[0] == 'index']
+            batch = [write for write in batch if write[0] != 'index']
+
+            with db:
+                for seq, key, encoded in batch:
+                    if encoded is None:
+                        db.execute('DELETE FROM kv WHERE key = ?', (key,))
+                    else:
+                        db.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, encoded))
+                    self._sqlite_index_key(db, indexed, key, encoded)
+
+                # after the writes that came with them, so a build sees them
+                for op, prefix, field, built in builds:
+                    self._sqlite_build_index(db, indexed, prefix, field)
+
+            # committed, so queries on these indexes can go ahead
+            for op, prefix, field, built in builds:
+                built.set()
+
+            # committed, so readers can go to the database for these now.
+            # newer writes to the same key stay pending
+            with self._store_lock:
+                for seq, key, encoded in batch:
+                    if self._pending.get(key, (None,))[0] == seq:
+                        del self._pending[key]
+
+        db.close()
+
+    def _sqlite_index_key(self, db, indexed, key, encoded):
+        fields = set()
+        for prefix, prefix_fields in indexed.items():
+            if key.startswith(prefix):
+                fields |= prefix_fields
+        if not fields:
+            return
+
+        db.execute('DELETE FROM kv_index WHERE key = ?', (key,))
+        if encoded is None:
+            return
+        value = json.loads(encoded)
+        for field in fields:
+            encoded_value = index_value(value, field)
+            if encoded_value is not None:
+                db.execute('INSERT INTO kv_index (field, value, key) VALUES (?, ?, ?)', (field, encoded_value, key))
+
+    def _sqlite_build_index(self, db, indexed, prefix, field):
+        if field not in indexed.get(prefix, ()):
+            ctx = get_context()
+            ctx.logger.info('building data store index on {} for keys starting with {}'.format(field, prefix))
+
+            rows = db.execute('SELECT key, value FROM kv WHERE key >= ? AND key < ?', (prefix, prefix_upper(prefix)))
+            for key, encoded in rows.fetchall():
+                encoded_value = index_value(json.loads(encoded), field)
+                if encoded_value is not None:
+                    db.execute('INSERT OR REPLACE INTO kv_index (field, value, key) VALUES (?, ?, ?)', (field, encoded_value, key))
+            db.execute('INSERT INTO kv_indexes (prefix, field) VALUES (?, ?)', (prefix, field))
+            indexed.setdefault(prefix, set()).add(field)
+
+    def _sqlite_write(self, key, encoded):
+        with self._store_lock:
+            self._pending_seq += 1
+            seq = self._pending_seq
+            self._pending[key] = (seq, encoded)
+        self._write_queue.put((seq, key, encoded))
+
+    def _sqlite_cache(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _sqlite_get(self, key, default):
+        try:
+            value = self._cache[key]
+            self._cache.move_to_end(key)
+            return value
+        except KeyError:
+            pass
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            encoded = pending[1]
+        else:
+            row = self._db.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            encoded = row[0] if row is not None else None
+
+        if encoded is None:
+            return default
+
+        value = json.loads(encoded)
+        self._sqlite_cache(key, value)
+        return value
+
+    def _sqlite_list_keys(self, prefix):
+        # pending first: a write committed after the query is then still seen
+        with self._store_lock:
+            pending = list(self._pending.items())
+
+        if prefix:
+            # every key starting with prefix sorts between these two
+            rows = self._db.execute('SELECT key FROM kv WHERE key >= ? AND key < ?', (prefix, prefix_upper(prefix)))
+        else:
+            rows = self._db.execute('SELECT key FROM kv')
+        keys = set(row[0] for row in rows)
+
+        for key, (seq, encoded) in pending:
+            if prefix is None or key.startswith(prefix):
+                if encoded is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+
+        return list(keys)
+
     # single keys
     def __contains__(self, key):
-        if self.format == 'json':
+        if self.format in memory_formats:
             return key in self._store
+        elif self.format == 'sqlite':
+            return self._sqlite_get(key, None) is not None
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
     def get(self, key, default=None):
-        if self.format == 'json':
+        """Returns the value of key.  Changing it in place isn't saved; put() a new value."""
+        if self.format in memory_formats:
             return self._store.get(key, default)
+        elif self.format == 'sqlite':
+            return self._sqlite_get(key, default)
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
     def put(self, key, value):
-        if self.format == 'json':
+        if self.format in memory_formats:
             # make sure we can serialize the given data
             # so we don't choke later on saving the db out
-            json.dumps(value)
+            encoded = json.dumps(value)
 
             self._store[key] = value
+            self._dirty[key] = encoded
 
-            return True
+            if self.format == 'journal':
+                self._journal_append('p', key, encoded)
+        elif self.format == 'sqlite':
+            encoded = json.dumps(value)
+            self._sqlite_cache(key, value)
+            self._sqlite_write(key, encoded)
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
+        for collection in self._collections_for(key):
+            collection._updated(key, value)
+
+        return True
+
     def delete(self, key):
-        if self.format == 'json':
+        if self.format in memory_formats:
             try:
                 with self._store_lock:
                     del self._store[key]
             except KeyError:
                 # key is already gone, nothing to do
-                ...
+                return True
 
-            return True
+            self._dirty[key] = None
+
+            if self.format == 'journal':
+                self._journal_append('d', key)
+        elif self.format == 'sqlite':
+            self._cache.pop(key, None)
+            self._sqlite_write(key, None)
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
+        for collection in self._collections_for(key):
+            collection._deleted(key)
+
+        return True
+
     # multiple keys
     def list_keys(self, prefix=None):
         """Return all key names. If prefix given, return only keys that start with it."""
-        if self.format == 'json':
+        if self.format in memory_formats:
             keys = []
 
             with self._store_lock:
@@ -111,15 +873,49 @@ class DataStore:
                         keys.append(key)
 
             return keys
+        elif self.format == 'sqlite':
+            return self._sqlite_list_keys(prefix)
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
 
     def delete_keys(self, prefix):
         """Delete all keys with the given prefix."""
-        if self.format == 'json':
+        if self.format in memory_formats:
+            deleted = []
             with self._store_lock:
                 for key in tuple(self._store):
                     if key.startswith(prefix):
                         del self._store[key]
+                        self._dirty[key] = None
+                        deleted.append(key)
+
+            for key in deleted:
+                for collection in self._collections_for(key):
+                    collection._deleted(key)
+
+            if self.format == 'journal':
+                self._journal_append('x', prefix)
+        elif self.format == 'sqlite':
+            for key in self._sqlite_list_keys(prefix):
+                self.delete(key)
         else:
             raise Exception('Data store format [{}] not recognised'.format(self.format))
+
+    # collections
+    def collection(self, name, prefix=None, indexes=()):
+        """Return the named collection, creating it over the keys starting with prefix
+        (the name and a dot by default).  Fields in indexes are indexed, on an existing
+        collection as well."""
+        collection = self.collections.get(name, None)
+        if collection is None:
+            cls = SqliteCollection if self.format == 'sqlite' else Collection
+            collection = cls(self, name, prefix if prefix is not None else name + '.')
+            self.collections[name] = collection
+
+        for field in indexes:
+            collection.add_index(field)
+
+        return collection
+
+    def _collections_for(self, key):
+        return [collection for collection in self.collections.values() if key.startswith(collection.prefix)]
@@ -62,9 +62,18 @@ class EventManager(EventManagerBase):
 
 class RFC1459EventManager(EventManager):
     """A specialized event manager for RFC1459 commands.
-    If an EventObject does not exist, then we send numeric 421."""
+    If an EventObject does not exist, then we send numeric 421.
+
+    Each command has a cost, in flood tokens, that is charged to the client
+    sending it.  Handlers declare a base cost when registering, and the flood
+    section of the config may override it."""
     def __init__(self):
         super(RFC1459EventManager, self).__init__()
+        self.costs = dict()
+
+    def cost(self, verb):
+        """Returns the base cost of a command."""
+        return self.costs.get(verb.upper(), 1)
 
     def dispatch(self, event, ev_msg):
         """Dispatch an event.
@@ -83,7 +92,8 @@ class RFC1459EventManager(EventManager):
         cli = ev_msg['client']
         cli.dump_numeric('421', [ev_msg['verb'], 'Unknown command'])
 
-    def message(self, verb, min_params=0, update_idle=False, priority=10, allow_unregistered=False):
+    def message(self, verb, min_params=0, update_idle=False, priority=10, allow_unregistered=False, cost=1):
+        self.costs[verb.upper()] = max(cost, self.costs.get(verb.upper(), cost))
         def parent_fn(func):
             @wraps(func)
             def child_fn(ev_msg):
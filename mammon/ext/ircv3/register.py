@@ -17,10 +17,14 @@
 
 from mammon.events import eventmgr_core, eventmgr_rfc1459
 from mammon.isupport import get_isupport
+from mammon.server import get_context
+from mammon.core.rfc1459.stats import stats_query
 
 from datetime import timedelta
 from email.mime.text import MIMEText
 from subprocess import Popen, PIPE
+import asyncio
+import heapq
 
 global supported_cred_types
 global supported_cb_types
@@ -32,6 +36,48 @@ supported_cb_types = ['*', 'mailto']
 enabled_cb_types = []
 verify_timeout_seconds = 0
 
+# (expiry ts, account) for unverified accounts, soonest first.  entries can be
+# stale, the account is checked again before it's purged
+pending_expiry = []
+sweep_stats = {
+    'purged': 0,
+}
+
+# accounts being created while their passphrase is hashed
+pending_accounts = set()
+
+def expire_account_later(account, registered_ts):
+    heapq.heappush(pending_expiry, (registered_ts + verify_timeout_seconds, account))
+
+def sweep_expired():
+    """Purges unverified accounts past their verify timeout, a bounded batch
+    within a time budget at a time, and re-arms itself."""
+    ctx = get_context()
+    conf = ctx.conf.register
+    deadline = ctx.clock.monotonic() + conf.get('sweep_budget_ms', 5) / 1000.0
+    batch = conf.get('sweep_batch', 100)
+
+    accounts = ctx.data.collection('accounts')
+    while pending_expiry and pending_expiry[0][0] <= ctx.current_ts and batch > 0:
+        expires, account = heapq.heappop(pending_expiry)
+
+        account_data = accounts.get(account, None)
+        if account_data and not account_data['verified'] and account_data['registered_ts'] + verify_timeout_seconds <= ctx.current_ts:
+            accounts.delete(account)
+            sweep_stats['purged'] += 1
+            batch -= 1
+
+        if ctx.clock.monotonic() > deadline:
+            break
+
+    ctx.timers.schedule(sweep_expired, conf.get('sweep_interval', 10), ctx.clock.monotonic())
+
+@stats_query('r')
+def stats_registrations(cli):
+    accounts = cli.ctx.data.collection('accounts')
+    cli.dump_numeric('249', ['r accounts {} unverified {} purged {} queued {}'.format(
+        len(accounts), len(accounts.find('verified', False)), sweep_stats['purged'], len(pending_expiry))])
+
 def generate_auth_code():
     from passlib.utils import generate_password
     code = generate_password(size=15)
@@ -41,6 +87,8 @@ def generate_auth_code():
 def m_server_start(info):
     ctx = info['server']
 
+    ctx.data.collection('accounts', 'account.', indexes=['verified', 'callback'])
+
     if not ctx.hashing.enabled:
         ctx.logger.info('REG disabled because hashing is not available')
         return
@@ -69,6 +117,11 @@ def m_server_start(info):
     global verify_timeout_seconds
     verify_timeout_seconds = timedelta(**ctx.conf.register['verify_timeout']).total_seconds()
 
+    accounts = ctx.data.collection('accounts')
+    for account in accounts.find('verified', False):
+        expire_account_later(account, accounts.get(account)['registered_ts'])
+    sweep_expired()
+
 @eventmgr_rfc1459.message('REG', min_params=3)
 def m_REG(cli, ev_msg):
     params = list(ev_msg['params'])
@@ -81,6 +134,10 @@ def m_REG(cli, ev_msg):
             cli.dump_numeric('922', [account, 'Invalid params: "*" is not a valid account name'])
             return
 
+        if account in pending_accounts:
+            cli.dump_numeric('921', [account, 'Account already exists'])
+            return
+
         account_data = cli.ctx.data.get('account.{}'.format(account), {})
         if account_data:
             global verify_timeout_seconds
@@ -144,7 +201,7 @@ def m_REG(cli, ev_msg):
             auth_code = params.pop(0)
 
             if auth_code == account_info['auth_code']:
-                account_info['verified'] = True
+                account_info = dict(account_info, verified=True)
                 del account_info['auth_code']
                 cli.ctx.data.put('account.{}'.format(account), account_info)
 
@@ -164,15 +221,39 @@ def m_REG(cli, ev_msg):
     else:
         cli.dump_numeric('400', ['REG', ev_msg['params'][0], 'Unknown subcommand'])
 
+def hash_credential(info):
+    """Hash the new account's passphrase and derive its SCRAM keys off the event
+    loop, as a coroutine.  Returns the credentials, or None if the client left in
+    the meantime."""
+    cli = info['source']
+    try:
+        passphrase = yield from cli.ctx.hashing.encrypt_async(info['credential'])
+        scram = yield from cli.ctx.hashing.scram_derive_async(info['credential'])
+    finally:
+        pending_accounts.discard(info['account'])
+
+    if not cli.connected:
+        return None
+    return {
+        'passphrase': passphrase,
+        'scram-sha-256': scram,
+    }
+
 @eventmgr_core.handler('reg callback *')
 def m_reg_create_empty(info):
+    pending_accounts.add(info['account'])
+    asyncio.async(do_reg_create_empty(info))
+
+def do_reg_create_empty(info):
     cli = info['source']
 
+    credentials = yield from hash_credential(info)
+    if credentials is None:
+        return
+
     cli.ctx.data.put('account.{}'.format(info['account']), {
         'account': info['account'],
-        'credentials': {
-            'passphrase': cli.ctx.hashing.encrypt(info['credential']),
-        },
+        'credentials': credentials,
         'registered_ts': cli.ctx.current_ts,
         'registered_by': cli.hostmask,
         'verified': True,
@@ -189,21 +270,29 @@ def m_reg_create_empty(info):
     cli.dump_numeric('903', ['Authentication successful'])
 
 @eventmgr_core.handler('reg callback mailto')
-def m_reg_create_empty(info):
+def m_reg_create_mailto(info):
+    pending_accounts.add(info['account'])
+    asyncio.async(do_reg_create_mailto(info))
+
+def do_reg_create_mailto(info):
     cli = info['source']
 
+    credentials = yield from hash_credential(info)
+    if credentials is None:
+        return
+
     auth_code = generate_auth_code()
 
     cli.ctx.data.put('account.{}'.format(info['account']), {
         'account': info['account'],
-        'credentials': {
-            'passphrase': cli.ctx.hashing.encrypt(info['credential']),
-        },
+        'credentials': credentials,
         'registered_ts': cli.ctx.current_ts,
         'registered_by': cli.hostmask,
         'verified': False,
         'auth_code': auth_code,
+        'callback': 'mailto:{}'.format(info['callback']),
     })
+    expire_account_later(info['account'], cli.ctx.current_ts)
 
     conf = cli.ctx.conf.register['callbacks']['mailto']
 
@@ -14,26 +14,37 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
-
 from mammon.events import eventmgr_core, eventmgr_rfc1459
 from mammon.capability import Capability, caplist
 
+import asyncio
 import base64
 import binascii
+import hashlib
+import hmac
+import os
 
-valid_mechanisms = ['PLAIN']
+valid_mechanisms = ['PLAIN', 'SCRAM-SHA-256', 'EXTERNAL']
 
 cap_sasl = Capability('sasl', value=','.join(valid_mechanisms))
 
+# used to make up SCRAM salts for accounts that don't exist, so they look
+# the same as ones that do
+scram_fake_key = os.urandom(32)
+
 @eventmgr_core.handler('server start')
 def m_sasl_start(info):
     ctx = info['server']
+    # certificate fingerprint -> account, for EXTERNAL
+    ctx.data.collection('certfps', 'certfp.', indexes=['account'])
+
     if not ctx.hashing.enabled:
         ctx.logger.info('SASL PLAIN disabled because hashing is not available')
         valid_mechanisms.remove('PLAIN')
     if len(valid_mechanisms) == 0:
         ctx.logger.info('SASL disabled because no mechanisms are available')
         del caplist['sasl']
+    cap_sasl.value = ','.join(valid_mechanisms)
 
 @eventmgr_rfc1459.message('AUTHENTICATE', min_params=1, allow_unregistered=True)
 def m_AUTHENTICATE(cli, ev_msg):
@@ -54,31 +65,29 @@ def m_AUTHENTICATE(cli, ev_msg):
             cli.sasl = None
             cli.sasl_tmp = ''
             return
-        elif len(raw_data) == 400:
-            if not hasattr(cli, 'sasl_tmp'):
-                cli.sasl_tmp = ''
-            cli.sasl_tmp += raw_data
+
+        # '+' on its own is an empty message, or ends one that was a multiple of 400 bytes
+        sasl_tmp = getattr(cli, 'sasl_tmp', '')
+        if raw_data != '+':
+            sasl_tmp += raw_data
+
+        if len(raw_data) == 400:
+            cli.sasl_tmp = sasl_tmp
             # allow 4 'continuation' lines before rejecting for length
             if len(cli.sasl_tmp) > 400 * 4:
                 cli.dump_numeric('904', ['SASL authentication failed: Password too long'])
                 cli.sasl = None
                 cli.sasl_tmp = ''
             return
-        elif getattr(cli, 'sasl_tmp', None):
-            if raw_data != '+':
-                cli.sasl_tmp += raw_data
+
+        cli.sasl_tmp = ''
 
         try:
-            if hasattr(cli, 'sasl_tmp'):
-                data = base64.b64decode(cli.sasl_tmp)
-            else:
-                data = base64.b64decode(raw_data)
+            data = base64.b64decode(sasl_tmp)
         except binascii.Error:
             cli.dump_numeric('904', ['SASL authentication failed'])
             return
 
-        cli.sasl_tmp = ''
-
         eventmgr_core.dispatch('sasl authenticate {}'.format(cli.sasl.casefold()), {
             'source': cli,
             'mechanism': cli.sasl,
@@ -89,7 +98,8 @@ def m_AUTHENTICATE(cli, ev_msg):
         mechanism = ev_msg['params'][0].upper()
         if mechanism in valid_mechanisms:
             cli.sasl = mechanism
-            cli.dump_verb('AUTHENTICATE', '+')
+            cli.sasl_scram = None
+            cli.dump_verb('AUTHENTICATE', ['+'])
         else:
             cli.dump_numeric('904', ['SASL authentication failed'])
             return
@@ -101,6 +111,32 @@ def m_sasl_unreglocked(info):
         cli.sasl = None
         cli.dump_numeric('906', ['SASL authentication aborted'])
 
+def dump_sasl(cli, data):
+    """Send data to the client in AUTHENTICATE messages of up to 400 bytes."""
+    encoded = str(base64.b64encode(data), 'ascii')
+    while len(encoded) >= 400:
+        cli.dump_verb('AUTHENTICATE', [encoded[:400]])
+        encoded = encoded[400:]
+    cli.dump_verb('AUTHENTICATE', [encoded or '+'])
+
+def sasl_success(cli, account):
+    cli.account = account
+    eventmgr_core.dispatch('account change', {
+        'source': cli,
+        'account': account,
+    })
+    cli.sasl = None
+    hostmask = cli.hostmask
+    if hostmask is None:
+        hostmask = '*'
+    cli.dump_numeric('900', [hostmask, account, 'You are now logged in as {}'.format(account)])
+    cli.dump_numeric('903', ['SASL authentication successful'])
+
+def sasl_failure(cli):
+    cli.sasl = None
+    cli.sasl_scram = None
+    cli.dump_numeric('904', ['SASL authentication failed'])
+
 @eventmgr_core.handler('sasl authenticate plain')
 def m_sasl_plain(info):
     cli = info['source']
@@ -122,18 +158,250 @@ def m_sasl_plain(info):
     account_info = cli.ctx.data.get('account.{}'.format(account), None)
     if (account_info and 'passphrase' in account_info['credentials'] and
             account_info['verified'] and authorization_id == account):
-        passphrase_hash = account_info['credentials']['passphrase']
-        if cli.ctx.hashing.verify(passphrase, passphrase_hash):
-            cli.account = account
-            eventmgr_core.dispatch('account change', {
-                'source': cli,
-                'account': account,
-            })
-            cli.sasl = None
-            hostmask = cli.hostmask
-            if hostmask is None:
-                hostmask = '*'
-            cli.dump_numeric('900', [hostmask, account, 'You are now logged in as {}'.format(account)])
-            cli.dump_numeric('903', ['SASL authentication successful'])
-            return
+        # registration waits for the result
+        cli.push_registration_lock('SASL')
+        asyncio.async(do_sasl_plain(cli, account, passphrase, account_info['credentials']['passphrase']))
+        return
     cli.dump_numeric('904', ['SASL authentication failed'])
+
+def do_sasl_plain(cli, account, passphrase, passphrase_hash):
+    """Verify a SASL PLAIN passphrase off the event loop, as a coroutine."""
+    try:
+        cache = cli.ctx.hashing.verified_cache
+        if cache is not None and cache.check(account, passphrase, passphrase_hash):
+            is_valid = True
+        else:
+            is_valid = yield from cli.ctx.hashing.verify_async(passphrase, passphrase_hash)
+            if is_valid and cache is not None:
+                cache.add(account, passphrase, passphrase_hash)
+
+        if is_valid:
+            # accounts from before SCRAM support get their keys, and passphrases
+            # hashed with old settings are rehashed, the first time we can
+            account_info = cli.ctx.data.get('account.{}'.format(account), None)
+            rehash = cli.ctx.hashing.needs_update(passphrase_hash)
+            derive_scram = account_info and 'scram-sha-256' not in account_info['credentials']
+            if rehash or derive_scram:
+                asyncio.async(update_credentials(cli.ctx, account, passphrase, passphrase_hash, rehash, derive_scram))
+        del passphrase
+
+        if not cli.connected or cli.sasl != 'PLAIN':
+            # gone, or aborted while we were verifying
+            return
+
+        if is_valid:
+            sasl_success(cli, account)
+            return
+        sasl_failure(cli)
+    finally:
+        if cli.connected:
+            cli.release_registration_lock('SASL')
+
+def update_credentials(ctx, account, passphrase, passphrase_hash, rehash, derive_scram):
+    """Rehash an account's passphrase with the current settings and/or derive its
+    SCRAM-SHA-256 keys, as a coroutine."""
+    credentials = dict()
+    if rehash:
+        credentials['passphrase'] = yield from ctx.hashing.encrypt_async(passphrase)
+    if derive_scram:
+        credentials['scram-sha-256'] = yield from ctx.hashing.scram_derive_async(passphrase)
+    del passphrase
+
+    # only if the passphrase didn't change while we were hashing
+    account_info = ctx.data.get('account.{}'.format(account), None)
+    if account_info and account_info['credentials'].get('passphrase') == passphrase_hash:
+        credentials = dict(account_info['credentials'], **credentials)
+        account_info = dict(account_info, credentials=credentials)
+        ctx.data.put('account.{}'.format(account), account_info)
+
+def scram_attributes(message):
+    """Parse a SCRAM message into a dict of attributes, or None if it's malformed."""
+    attributes = dict()
+    for part in message.split(','):
+        if len(part) < 2 or part[1] != '=':
+            return None
+        attributes[part[0]] = part[2:]
+    return attributes
+
+@eventmgr_core.handler('sasl authenticate scram-sha-256')
+def m_sasl_scram_sha_256(info):
+    cli = info['source']
+
+    try:
+        message = str(info['data'], 'utf8')
+    except UnicodeDecodeError:
+        sasl_failure(cli)
+        return
+
+    scram = getattr(cli, 'sasl_scram', None)
+    if scram is None:
+        scram_client_first(cli, message)
+    elif scram['step'] == 'client-final':
+        scram_client_final(cli, scram, message)
+    elif scram['step'] == 'done' and not message:
+        # the client accepted our signature
+        cli.sasl_scram = None
+        sasl_success(cli, scram['account'])
+    else:
+        sasl_failure(cli)
+
+def scram_client_first(cli, message):
+    # gs2 header, we don't do channel binding
+    try:
+        cbind_flag, authzid, client_first_bare = message.split(',', 2)
+    except ValueError:
+        sasl_failure(cli)
+        return
+    attributes = scram_attributes(client_first_bare)
+    if cbind_flag not in ('n', 'y') or not attributes or 'm' in attributes or 'n' not in attributes or not attributes.get('r'):
+        sasl_failure(cli)
+        return
+
+    # an authzid is 'a=' and a saslname, and we only allow logging in as yourself
+    account = attributes['n'].replace('=2C', ',').replace('=3D', '=')
+    if authzid and (not authzid.startswith('a=') or authzid[2:].replace('=2C', ',').replace('=3D', '=') != account):
+        sasl_failure(cli)
+        return
+
+    account_info = cli.ctx.data.get('account.{}'.format(account), None)
+    credential = None
+    if account_info and account_info['verified']:
+        credential = account_info['credentials'].get('scram-sha-256', None)
+
+    if credential is not None:
+        salt = credential['salt']
+        iterations = credential['iterations']
+    else:
+        # carry on with a made up salt, failing at the end, so we don't
+        # give away which accounts exist
+        salt = str(base64.b64encode(hmac.new(scram_fake_key, account.encode('utf-8'), hashlib.sha256).digest()[:16]), 'ascii')
+        iterations = cli.ctx.hashing.scram_iterations
+
+    nonce = attributes['r'] + str(base64.b64encode(os.urandom(18)), 'ascii')
+    server_first = 'r={},s={},i={}'.format(nonce, salt, iterations)
+
+    cli.sasl_scram = {
+        'step': 'client-final',
+        'account': account,
+        'credential': credential,
+        'gs2_header': message[:len(message) - len(client_first_bare)],
+        'nonce': nonce,
+        'auth_message': client_first_bare + ',' + server_first,
+    }
+    dump_sasl(cli, server_first.encode('utf-8'))
+
+def scram_client_final(cli, scram, message):
+    without_proof, sep, proof = message.rpartition(',p=')
+    attributes = scram_attributes(without_proof)
+    if not sep or not attributes:
+        sasl_failure(cli)
+        return
+
+    try:
+        channel_binding = base64.b64decode(attributes.get('c', ''))
+        proof = base64.b64decode(proof)
+    except binascii.Error:
+        sasl_failure(cli)
+        return
+
+    credential = scram['credential']
+    if (credential is None or attributes.get('r') != scram['nonce'] or
+            channel_binding != scram['gs2_header'].encode('utf-8')):
+        sasl_failure(cli)
+        return
+
+    # the client proves it knows the client key, which hashes to our stored key
+    auth_message = (scram['auth_message'] + ',' + without_proof).encode('utf-8')
+    stored_key = base64.b64decode(credential['stored_key'])
+    client_signature = hmac.new(stored_key, auth_message, hashlib.sha256).digest()
+    client_key = bytes(a ^ b for a, b in zip(proof, client_signature))
+    if len(proof) != len(client_signature) or not hmac.compare_digest(hashlib.sha256(client_key).digest(), stored_key):
+        sasl_failure(cli)
+        return
+
+    server_key = base64.b64decode(credential['server_key'])
+    server_signature = hmac.new(server_key, auth_message, hashlib.sha256).digest()
+
+    scram['step'] = 'done'
+    scram['credential'] = None
+    dump_sasl(cli, b'v=' + base64.b64encode(server_signature))
+
+@eventmgr_core.handler('sasl authenticate external')
+def m_sasl_external(info):
+    cli = info['source']
+
+    try:
+        authorization_id = str(info['data'], 'utf8')
+    except UnicodeDecodeError:
+        sasl_failure(cli)
+        return
+
+    entry = None
+    if cli.certfp:
+        entry = cli.ctx.data.collection('certfps').get(cli.certfp, None)
+    if entry is None:
+        sasl_failure(cli)
+        return
+
+    account = entry['account']
+    account_info = cli.ctx.data.get('account.{}'.format(account), None)
+    if not account_info or not account_info['verified'] or authorization_id not in ('', account):
+        sasl_failure(cli)
+        return
+
+    sasl_success(cli, account)
+
+@eventmgr_rfc1459.message('CERTFP', min_params=1)
+def m_CERTFP(cli, ev_msg):
+    """Manage the certificate fingerprints that can log in to an account with EXTERNAL.
+    CERTFP LIST, CERTFP ADD [fingerprint] and CERTFP DEL <fingerprint>, for the account
+    you're logged in to.  ADD only takes the fingerprint of the certificate you're using.
+    opers can name any account first: CERTFP LIST [account], CERTFP ADD [account
+    [fingerprint]] and CERTFP DEL [account] <fingerprint>, and can add any fingerprint."""
+    params = list(ev_msg['params'])
+    subcmd = params.pop(0).casefold()
+    is_oper = cli.props.get('special:oper', False)
+
+    account = cli.account
+    if is_oper and params and (subcmd != 'del' or len(params) > 1):
+        account = params.pop(0)
+    if not account:
+        cli.dump_notice('CERTFP: You are not logged in')
+        return
+
+    certfps = cli.ctx.data.collection('certfps')
+
+    if subcmd == 'list':
+        for certfp in sorted(certfps.find('account', account)):
+            cli.dump_notice('CERTFP: {} {}'.format(account, certfp))
+        cli.dump_notice('CERTFP: End of list')
+    elif subcmd == 'add':
+        certfp = params[0].casefold().replace(':', '') if params else cli.certfp
+        if not certfp:
+            cli.dump_notice('CERTFP: You are not using a client certificate')
+            return
+        if len(certfp) != 64 or any(c not in '0123456789abcdef' for c in certfp):
+            cli.dump_notice('CERTFP: Invalid fingerprint, expected a sha256 hex digest')
+            return
+        if not is_oper and certfp != cli.certfp:
+            cli.dump_notice('CERTFP: You can only add the fingerprint of the certificate you are using')
+            return
+        if certfp in certfps:
+            cli.dump_notice('CERTFP: {} is already in use'.format(certfp))
+            return
+        certfps.put(certfp, {
+            'account': account,
+            'added_ts': cli.ctx.current_ts,
+            'added_by': cli.hostmask,
+        })
+        cli.dump_notice('CERTFP: Added {} to {}'.format(certfp, account))
+    elif subcmd == 'del' and params:
+        certfp = params[0].casefold().replace(':', '')
+        entry = certfps.get(certfp, None)
+        if entry is None or entry['account'] != account:
+            cli.dump_notice('CERTFP: {} is not on {}'.format(certfp, account))
+            return
+        certfps.delete(certfp)
+        cli.dump_notice('CERTFP: Removed {} from {}'.format(certfp, account))
+    else:
+        cli.dump_notice('CERTFP: Usage: CERTFP LIST|ADD [fingerprint]|DEL <fingerprint>')
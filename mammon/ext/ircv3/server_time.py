@@ -15,14 +15,14 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-import time
-
+from mammon.client import message_variant_caps
 from mammon.server import eventmgr_core
 from mammon.capability import Capability
 
 cap_server_time = Capability('server-time')
+message_variant_caps.append('server-time')
 
 @eventmgr_core.handler('outbound message postprocess', priority=1)
 def m_server_time(m):
     if 'server-time' in m.client.caps:
-        m.tags['time'] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(m.client.ctx.current_ts))
+        m.tags['time'] = m.client.ctx.clock.isotime()
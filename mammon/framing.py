@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+class LineFramer(object):
+    """Splits a byte stream into lines using a preallocated buffer.
+
+    Incoming data is copied into the buffer once, and only bytes that have not
+    been scanned yet are searched for a newline, so a line that trickles in a
+    byte at a time costs O(length) instead of O(length^2).  Lines longer than
+    max_line are truncated while framing, before anything is decoded.
+
+    get_buffer() and buffer_updated() follow the asyncio.BufferedProtocol
+    interface, so a transport can read straight into the buffer.  feed() is
+    for transports that hand us bytes objects."""
+    def __init__(self, max_line=None, size=8192):
+        if max_line:
+            size = max(size, max_line * 2)
+
+        self.max_line = max_line
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0      # start of the line currently being framed
+        self.end = 0        # end of the data in the buffer
+        self.scanned = 0    # there is no newline between start and here
+
+    def get_buffer(self, sizehint=-1):
+        """Returns a writable view of the free space in the buffer."""
+        self._make_room()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Accounts for nbytes written into the view from get_buffer(), returning completed lines."""
+        self.end += nbytes
+        return self._frame()
+
+    def feed(self, data):
+        """Copies data into the buffer, returning completed lines."""
+        lines = []
+        idx = data.rfind(b'\n')
+        if idx >= 0:
+            # split the complete lines straight out of data, after whatever was
+            # pending, and only put what's left of it through the buffer
+            block = data[:idx]
+            if self.start != self.end:
+                block = bytes(self.view[self.start:self.end]) + block
+            lines = self._split(block)
+            self.start = self.end = self.scanned = 0
+            data = data[idx + 1:]
+
+            # the rest has no newline and the buffer is empty, so it can go straight in
+            if len(data) <= len(self.buffer):
+                if self.max_line and len(data) > self.max_line:
+                    data = data.replace(b'\r', b'')[:self.max_line]
+                self.buffer[:len(data)] = data
+                self.end = self.scanned = len(data)
+                return lines
+
+        data = memoryview(data)
+        while data:
+            free = self.get_buffer()
+            nbytes = min(len(free), len(data))
+            free[:nbytes] = data[:nbytes]
+            lines.extend(self.buffer_updated(nbytes))
+            data = data[nbytes:]
+        return lines
+
+    def _make_room(self):
+        if self.end < len(self.buffer):
+            return
+
+        if self.start:
+            # move the partial line to the front of the buffer
+            pending = self.end - self.start
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+            self.scanned -= self.start
+            self.start = 0
+            self.end = pending
+        else:
+            # only reachable without a line limit, a single line fills the buffer
+            buffer = bytearray(len(self.buffer) * 2)
+            buffer[:self.end] = self.view[:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+
+    def _split(self, block):
+        lines = block.replace(b'\r', b'').split(b'\n')
+        if self.max_line and max(map(len, lines)) > self.max_line:
+            lines = [line[:self.max_line] for line in lines]
+        return lines
+
+    def _frame(self):
+        lines = []
+
+        idx = self.buffer.rfind(b'\n', self.scanned, self.end)
+        if idx >= 0:
+            # split every complete line out at once
+            lines = self._split(bytes(self.view[self.start:idx]))
+            self.start = self.scanned = idx + 1
+
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        else:
+            self.scanned = self.end
+
+            # drop the excess of an overlong line as it arrives, further data
+            # overwrites it until the newline turns up.  Like complete lines,
+            # it's measured without any CRs, so where it was split doesn't matter
+            if self.max_line and self.end - self.start > self.max_line:
+                pending = bytes(self.view[self.start:self.end]).replace(b'\r', b'')[:self.max_line]
+                self.buffer[self.start:self.start + len(pending)] = pending
+                self.end = self.scanned = self.start + len(pending)
+
+        return lines
@@ -15,10 +15,97 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import time
+
+# hashing runs in worker processes, which each build their own contexts
+# from the settings they're given
+worker_contexts = dict()
+
+def get_worker_context(settings):
+    context = worker_contexts.get(settings, None)
+    if context is None:
+        from passlib.context import CryptContext
+        context = worker_contexts[settings] = CryptContext(**dict(settings))
+    return context
+
+def worker_start():
+    return os.getpid()
+
+def worker_encrypt(settings, password, scheme):
+    return get_worker_context(settings).encrypt(password, scheme=scheme)
+
+def worker_verify(settings, password, hash):
+    return get_worker_context(settings).verify(password, hash)
+
+def scram_keys(salted_password):
+    """Returns the SCRAM-SHA-256 (stored key, server key) for a salted password."""
+    client_key = hmac.new(salted_password, b'Client Key', hashlib.sha256).digest()
+    server_key = hmac.new(salted_password, b'Server Key', hashlib.sha256).digest()
+    return hashlib.sha256(client_key).digest(), server_key
+
+def worker_scram_derive(password, salt, iterations):
+    salted_password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    stored_key, server_key = scram_keys(salted_password)
+    return {
+        'salt': base64.b64encode(salt).decode('ascii'),
+        'iterations': iterations,
+        'stored_key': base64.b64encode(stored_key).decode('ascii'),
+        'server_key': base64.b64encode(server_key).decode('ascii'),
+    }
+
+class VerifiedCache:
+    """Remembers passwords that verified recently, so repeated logins skip the hash.
+    Entries are keyed by account and an HMAC of the password under a key that only
+    lives in this process, and hold the hash they verified against, so changing the
+    stored hash invalidates them.  The least recently used entries go first."""
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = os.urandom(32)
+        self.entries = collections.OrderedDict()    # (account, mac) -> (hash, expires)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry_key(self, account, password):
+        return (account, hmac.new(self.key, password.encode('utf-8'), hashlib.sha256).digest())
+
+    def check(self, account, password, hash):
+        key = self.entry_key(account, password)
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            if entry[1] > time.monotonic() and hmac.compare_digest(entry[0], hash):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            del self.entries[key]
+
+        self.misses += 1
+        return False
+
+    def add(self, account, password, hash):
+        key = self.entry_key(account, password)
+        self.entries[key] = (hash, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
 class HashHandler:
     default_scheme = 'sha512_crypt'
     valid_schemes = ('sha512_crypt', 'pbkdf2_sha512')
 
+    # rounds tried by --benchmark-hashes
+    benchmark_rounds = (5000, 10000, 25000, 50000, 100000, 200000)
+
     def __init__(self):
         try:
             from passlib.context import CryptContext
@@ -26,8 +113,69 @@ class HashHandler:
         except ImportError:
             self.enabled = False
 
+        # scheme -> rounds, passlib's defaults are used for any not given
+        self.rounds = dict()
+        self.build_context()
+
+        # None runs hashing in the event loop's default thread pool
+        self.executor = None
+        self.workers = 0
+
+        self.verified_cache = None
+        self.scram_iterations = 4096
+
+    def build_context(self):
+        # hashes from other schemes or with fewer rounds need updating, and are
+        # rehashed the next time someone logs in with them
+        settings = {
+            'schemes': self.valid_schemes,
+            'default': self.default_scheme,
+            'deprecated': ('auto',),
+        }
+        for scheme, rounds in self.rounds.items():
+            settings['{}__default_rounds'.format(scheme)] = rounds
+            settings['{}__min_rounds'.format(scheme)] = rounds
+
+        # the workers get the settings with each job, so they have to be hashable
+        self.settings = tuple(sorted(settings.items()))
+
         if self.enabled:
-            self.context = CryptContext(schemes=self.valid_schemes)
+            from passlib.context import CryptContext
+            self.context = CryptContext(**settings)
+
+    def configure(self, conf):
+        scheme = conf.get('scheme', self.default_scheme)
+        if scheme in self.valid_schemes:
+            self.default_scheme = scheme
+        else:
+            print('mammon: error: hashing scheme {} is not valid, using {}'.format(scheme, self.default_scheme))
+        self.rounds = conf.get('rounds', None) or dict()
+        self.build_context()
+
+        self.workers = conf.get('workers', 2)
+        self.scram_iterations = conf.get('scram_iterations', 4096)
+        self.shutdown()
+        if self.enabled and self.workers:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.start_workers()
+
+        cache_conf = conf.get('verified_cache', None) or {}
+        if cache_conf.get('enabled', False):
+            self.verified_cache = VerifiedCache(cache_conf.get('ttl', 60), cache_conf.get('size', 10000))
+
+    def start_workers(self):
+        """Fork the workers now, while the only descriptors we hold are config and logs.
+        The pool forks lazily otherwise, and workers forked once the server is running
+        inherit the listeners and every client socket, which then stay open in the
+        worker after we close them."""
+        jobs = [self.executor.submit(worker_start) for i in range(self.workers)]
+        for job in jobs:
+            job.result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
 
     def encrypt(self, *args, **kwargs):
         return self.context.encrypt(*args, **kwargs)
@@ -40,3 +188,47 @@ class HashHandler:
 
         del password
         return is_valid
+
+    def needs_update(self, hash):
+        """Returns True if hash uses an older scheme or fewer rounds than configured."""
+        return self.enabled and self.context.needs_update(hash)
+
+    def benchmark(self, scheme, rounds, duration=0.5):
+        """Returns how many verifications per second this process manages with
+        the given scheme and rounds."""
+        from passlib.context import CryptContext
+        context = CryptContext(schemes=[scheme], **{'{}__default_rounds'.format(scheme): rounds})
+        hash = context.encrypt('benchmark passphrase')
+
+        count = 0
+        started = time.perf_counter()
+        while True:
+            context.verify('benchmark passphrase', hash)
+            count += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= duration:
+                return count / elapsed
+
+    def encrypt_async(self, password, scheme=None):
+        """Hash a password off the event loop, as a coroutine."""
+        loop = asyncio.get_event_loop()
+        hash = yield from loop.run_in_executor(self.executor, worker_encrypt, self.settings, password, scheme)
+        return hash
+
+    def verify_async(self, password, hash):
+        """Verify a password off the event loop, as a coroutine."""
+        if not self.enabled:
+            return False
+
+        loop = asyncio.get_event_loop()
+        is_valid = yield from loop.run_in_executor(self.executor, worker_verify, self.settings, password, hash)
+
+        del password
+        return is_valid
+
+    def scram_derive_async(self, password):
+        """Derive SCRAM-SHA-256 credentials for a password off the event loop, as a coroutine."""
+        loop = asyncio.get_event_loop()
+        credential = yield from loop.run_in_executor(self.executor, worker_scram_derive,
+                                                     password, os.urandom(16), self.scram_iterations)
+        return credential
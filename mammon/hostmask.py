@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import re
+
+def mask_to_regex(mask):
+    """Returns a regex pattern matching the same strings as the glob mask, where
+    '*' matches any run of characters and '?' matches exactly one."""
+    pattern = str()
+    for c in mask:
+        if c == '*':
+            pattern += '.*'
+        elif c == '?':
+            pattern += '.'
+        else:
+            pattern += re.escape(c)
+    return pattern
+
+def has_wildcards(mask):
+    return '*' in mask or '?' in mask
+
+class HostmaskMatcher(object):
+    """Matches a hostmask against a list of masks, such as a channel's bans, at once.
+
+    Masks are casefolded and filed by shape:
+      - masks without wildcards, in a dict
+      - '*!*@host' and '*@host' masks with a literal host, in a dict by host
+      - '*!*@*.suffix' and '*@*.suffix' masks, in a trie of reversed suffixes
+      - masks that start with a literal prefix, in a trie of those prefixes
+      - everything else, in one alternation regex, recompiled when it's next
+        needed after a change
+    A lookup only tries the masks its hostmask leads to, so it costs about one
+    step per character rather than one match per mask.  Adding and removing a
+    mask only touches the place it's filed in."""
+    def __init__(self, masks=()):
+        self.masks = dict()          # casefolded mask -> compiled regex
+        self.literal = dict()        # casefolded mask -> mask, for masks without wildcards
+        self.hosts = dict()          # host -> set of masks
+        self.suffixes = [set(), dict()]    # trie node: [masks ending here, char -> child node]
+        self.prefixes = [set(), dict()]
+        self.others = set()
+        self._others_regex = None
+        self._others_dirty = False
+
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __contains__(self, mask):
+        return mask.casefold() in self.masks
+
+    @staticmethod
+    def classify(mask):
+        """Returns where a (casefolded) mask is filed, and the key it's filed under."""
+        if not has_wildcards(mask):
+            return 'literal', mask
+
+        head, sep, host = mask.rpartition('@')
+        if sep and head in ('*', '*!*'):
+            if not has_wildcards(host):
+                return 'host', host
+            suffix = host.lstrip('*')
+            if suffix and not has_wildcards(suffix):
+                return 'suffix', suffix[::-1]
+
+        for i, c in enumerate(mask):
+            if c in '*?':
+                break
+        if i:
+            return 'prefix', mask[:i]
+        return 'other', None
+
+    def add(self, mask):
+        mask = mask.casefold()
+        if mask in self.masks:
+            return
+        self.masks[mask] = re.compile(mask_to_regex(mask) + r'\Z', re.DOTALL)
+
+        kind, key = self.classify(mask)
+        if kind == 'literal':
+            self.literal[mask] = mask
+        elif kind == 'host':
+            self.hosts.setdefault(key, set()).add(mask)
+        elif kind == 'suffix':
+            self.trie_add(self.suffixes, key, mask)
+        elif kind == 'prefix':
+            self.trie_add(self.prefixes, key, mask)
+        else:
+            self.others.add(mask)
+            self._others_dirty = True
+
+    def remove(self, mask):
+        mask = mask.casefold()
+        if self.masks.pop(mask, None) is None:
+            return
+
+        kind, key = self.classify(mask)
+        if kind == 'literal':
+            del self.literal[mask]
+        elif kind == 'host':
+            bucket = self.hosts[key]
+            bucket.discard(mask)
+            if not bucket:
+                del self.hosts[key]
+        elif kind == 'suffix':
+            self.trie_remove(self.suffixes, key, mask)
+        elif kind == 'prefix':
+            self.trie_remove(self.prefixes, key, mask)
+        else:
+            self.others.discard(mask)
+            self._others_dirty = True
+
+    @staticmethod
+    def trie_add(node, key, mask):
+        for c in key:
+            node = node[1].setdefault(c, [set(), dict()])
+        node[0].add(mask)
+
+    @staticmethod
+    def trie_remove(node, key, mask):
+        # walk down, then prune the nodes left empty on the way back up
+        path = []
+        for c in key:
+            path.append((node, c))
+            node = node[1][c]
+        node[0].discard(mask)
+        while path and not node[0] and not node[1]:
+            node, c = path.pop()
+            del node[1][c]
+
+    def trie_match(self, node, key, hostmask):
+        for c in key:
+            node = node[1].get(c, None)
+            if node is None:
+                return None
+            for mask in node[0]:
+                if self.masks[mask].match(hostmask):
+                    return mask
+        return None
+
+    def match(self, hostmask):
+        """Returns a mask matching hostmask, casefolded, or None."""
+        hostmask = hostmask.casefold()
+
+        if hostmask in self.literal:
+            return hostmask
+
+        for mask in self.hosts.get(hostmask.rpartition('@')[2], ()):
+            if self.masks[mask].match(hostmask):
+                return mask
+
+        mask = self.trie_match(self.suffixes, reversed(hostmask), hostmask) or self.trie_match(self.prefixes, hostmask, hostmask)
+        if mask is not None:
+            return mask
+
+        if self.others:
+            if self._others_dirty:
+                pattern = '|'.join('(?:{})'.format(mask_to_regex(mask)) for mask in self.others)
+                self._others_regex = re.compile(r'(?:{})\Z'.format(pattern), re.DOTALL)
+                self._others_dirty = False
+            if self._others_regex.match(hostmask):
+                # one of them matched, find out which
+                for mask in self.others:
+                    if self.masks[mask].match(hostmask):
+                        return mask
+
+        return None
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import collections
+
+class TokenBucket(object):
+    """Refills at rate tokens per second, up to burst tokens.
+    A client may send a line while it has at least one token.  Consuming more
+    than is available leaves the bucket in debt, which it must pay off before
+    the next line is accepted."""
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def ready(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def consume(self, cost, now):
+        self.refill(now)
+        self.tokens -= cost
+
+    def delay(self, now):
+        """Seconds until the bucket will hold a token again."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RecvQScheduler(object):
+    """Processes the recvqs of all clients in round-robin order.
+    Each pass handles at most lines_per_tick lines for a client, and only while
+    its flood bucket has tokens, so one client pasting a large block of text
+    cannot hold up everyone else."""
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.ready = collections.OrderedDict()   # clients with queued lines
+        self.handle = None
+        self.wakeup_ts = None
+
+    def schedule(self, cli):
+        """Make sure cli's recvq gets processed."""
+        if cli not in self.ready:
+            self.ready[cli] = True
+        self.wakeup(0)
+
+    def wakeup(self, delay):
+        loop = self.ctx.eventloop
+        when = loop.time() + delay
+
+        if self.handle is not None:
+            if self.wakeup_ts <= when:
+                return
+            self.handle.cancel()
+
+        self.wakeup_ts = when
+        if delay > 0:
+            self.handle = loop.call_later(delay, self.run)
+        else:
+            self.handle = loop.call_soon(self.run)
+
+    def run(self):
+        self.handle = None
+        next_delay = None
+
+        for cli in tuple(self.ready):
+            if cli.connected:
+                # a handler blowing up must not stall everyone else's recvq
+                try:
+                    cli.drain_queue(limit=self.ctx.flood_lines_per_tick)
+                except Exception:
+                    self.ctx.logger.exception('error processing recvq of {}'.format(cli.nickname))
+
+            if not cli.connected or not cli.recvq:
+                self.ready.pop(cli, None)
+                continue
+
+            # rotate to the back, so the next pass starts with someone else
+            self.ready.move_to_end(cli)
+
+            delay = cli.flood.delay(self.ctx.clock.monotonic())
+            if next_delay is None or delay < next_delay:
+                next_delay = delay
+
+        if next_delay is not None:
+            self.wakeup(next_delay)
@@ -32,6 +32,7 @@ class Role:
         self.capabilities = []
         self.title = ''
         self.whois_format = None
+        self.sendq_limit = None
 
         for k, v in kwargs.items():
             if v:
@@ -25,10 +25,14 @@ def get_context():
 
 from . import core
 from .config import ConfigHandler
-from .data import DataStore
+from .data import DataStore, convert_snapshot
 from .hashing import HashHandler
+from .xline import ServerBans
 from .utility import CaseInsensitiveList, CaseInsensitiveDict, ExpiringDict
 from .channel import ChannelManager
+from .recvq import RecvQScheduler
+from .timers import TimerWheel
+from .clock import Clock
 from .capability import caplist
 from .isupport import get_isupport
 
@@ -60,7 +64,11 @@ class ServerContext(object):
         self.logger.setLevel(logging.DEBUG)
 
         self.chmgr = ChannelManager(self)
+        self.recvq_scheduler = RecvQScheduler(self)
+        self.clock = Clock()
+        self.timers = TimerWheel(self.clock.monotonic())
         self.client_history = ExpiringDict(max_len=1024, max_age_seconds=86400)
+        self.xlines = ServerBans(self)
 
         # must be done before handling command line
         self.hashing = HashHandler()
@@ -84,7 +92,7 @@ class ServerContext(object):
         self.startstamp = time.strftime('%a %b %d %Y at %H:%M:%S %Z')
 
     def update_ts(self):
-        self.current_ts = time.time()
+        self.current_ts = self.clock.wall()
 
     def daemonize(self):
         self.pid = os.fork()
@@ -114,7 +122,12 @@ Options:
    --nofork            - Do not fork into background
    --config config     - A YAML configuration file to parse
    --list-hashes       - List the supported hashes for passwords
-   --mkpasswd          - Return hashed password, to put into config files""".format(cmd))
+   --mkpasswd          - Return hashed password, to put into config files
+   --benchmark-hashes [logins per second]
+                       - Measure password verification speed and recommend
+                         hashing rounds for the given login rate (default 50)
+   --convert-data json binary
+                       - Convert a json data store into a binary snapshot""".format(cmd))
         exit(1)
 
     def list_hashes(self):
@@ -147,9 +160,56 @@ Options:
 
         exit(1)
 
+    def benchmark_hashes(self):
+        if not self.hashing.enabled:
+            print('mammon: error: hashing is not enabled, try:  pip3 install passlib')
+            exit(1)
+
+        try:
+            target = int(sys.argv[sys.argv.index('--benchmark-hashes') + 1])
+        except (IndexError, ValueError):
+            target = 50
+        cpus = os.cpu_count() or 1
+
+        print('Password verifications per second on one core, for {} logins per second on {} cores:'.format(target, cpus))
+
+        for scheme in self.hashing.valid_schemes:
+            best = None
+            for rounds in self.hashing.benchmark_rounds:
+                rate = self.hashing.benchmark(scheme, rounds)
+                print('  {:<14} rounds {:>7} {:>10.1f}/s'.format(scheme, rounds, rate))
+                if rate * cpus >= target:
+                    best = (rounds, rate)
+
+            if best:
+                rounds, rate = best
+                workers = min(cpus, max(1, int(-(-target // rate))))
+                print('Recommended for {}:  rounds: {{{}: {}}}  workers: {}'.format(scheme, scheme, rounds, workers))
+            else:
+                print('No rounds value for {} reaches {} logins per second'.format(scheme, target))
+
+        exit(1)
+
+    def convert_data(self):
+        try:
+            index = sys.argv.index('--convert-data')
+            source, destination = sys.argv[index + 1:index + 3]
+        except ValueError:
+            print('mammon: error: --convert-data needs a source and destination filename')
+            exit(1)
+
+        count = convert_snapshot(os.path.expanduser(source), os.path.expanduser(destination))
+        print('Converted {} keys, set snapshot_format to "binary" to use it'.format(count))
+
+        exit(1)
+
     def handle_command_line(self):
         if '--help' in sys.argv:
             self.usage()
+        if '--benchmark-hashes' in sys.argv:
+            self.benchmark_hashes()
+        if '--convert-data' in sys.argv:
+            self.convert_data()
         if '--list-hashes' in sys.argv:
             self.list_hashes()
         if '--mkpasswd' in sys.argv:
@@ -191,6 +251,19 @@ Options:
 
         self.ping_frequency = datetime.timedelta(**self.conf.clients['ping_frequency']).total_seconds()
         self.ping_timeout = datetime.timedelta(**self.conf.clients['ping_timeout']).total_seconds()
+        self.sendq_flush_threshold = self.conf.clients.get('sendq_flush', 16384)
+        self.sendq_limit = self.conf.clients.get('sendq_limit', 1048576)
+
+        self.flood_burst = self.conf.flood.get('burst', 20)
+        self.flood_rate = self.conf.flood.get('rate', 4)
+        self.flood_lines_per_tick = self.conf.flood.get('lines_per_tick', 4)
+        self.flood_output_lines = self.conf.flood.get('output_lines', 20)
+
+        self.hashing.configure(self.conf.hashing)
+
+        # must be done after modules are loaded, so the config overrides their defaults
+        for verb, cost in (self.conf.flood.get('costs', None) or {}).items():
+            eventmgr_rfc1459.costs[verb.upper()] = cost
 
     def open_listeners(self):
         [asyncio.async(lstn) for lstn in self.listeners]
@@ -212,8 +285,10 @@ Options:
                 self.logger.addHandler(fh)
 
     def update_ts_callback(self):
-        self.update_ts()
+        # schedule the next tick first, so nothing a timer does can stop the clock
         self.eventloop.call_later(1, self.update_ts_callback)
+        self.update_ts()
+        self.timers.advance(self.clock.monotonic())
 
     def shutdown(self, reason):
         self.shutting_down = True
@@ -235,6 +310,10 @@ Options:
 
         self.data.create_or_load()
 
+        # ban expiry compares against current_ts, so it has to be set first
+        self.update_ts()
+        self.xlines.load()
+
         self.update_ts_callback()
         self.data.save_callback()
 
@@ -253,5 +332,6 @@ Options:
         finally:
             # always save data
             self.data.save()
+            self.hashing.shutdown()
 
         exit(0)
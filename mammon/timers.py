@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import logging
+import math
+
+class TimerWheel(object):
+    """Runs callbacks after a delay, with one second resolution.
+    Timers live in per-second buckets, so re-arming one is an O(1) move between
+    buckets rather than cancelling and re-creating an event loop timer.  The
+    callback itself is the key, so each callback can only be scheduled once.
+    The wheel is advanced by ServerContext.update_ts_callback."""
+    def __init__(self, now):
+        self.buckets = dict()   # second -> set of callbacks
+        self.timers = dict()    # callback -> second
+        self.last_tick = int(now)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, callback, delay, now):
+        """Runs callback delay seconds from now, replacing any pending run of it.
+        It may run up to a second late, but never early."""
+        self.cancel(callback)
+
+        # advance() runs a slot once now has reached it, so round the deadline up
+        slot = max(math.ceil(now + delay), self.last_tick + 1)
+        self.buckets.setdefault(slot, set()).add(callback)
+        self.timers[callback] = slot
+
+    def cancel(self, callback):
+        slot = self.timers.pop(callback, None)
+        if slot is None:
+            return
+
+        bucket = self.buckets.get(slot, None)
+        if bucket is not None:
+            bucket.discard(callback)
+            if not bucket:
+                del self.buckets[slot]
+
+    def advance(self, now):
+        """Runs every callback that is due by now.  A callback that raises is
+        logged, and doesn't stop the ones after it."""
+        now = int(now)
+        while self.last_tick < now:
+            self.last_tick += 1
+
+            bucket = self.buckets.pop(self.last_tick, None)
+            if not bucket:
+                continue
+
+            for callback in tuple(bucket):
+                # skip timers cancelled or re-armed by an earlier callback
+                if self.timers.get(callback, None) != self.last_tick:
+                    continue
+                del self.timers[callback]
+                try:
+                    callback()
+                except Exception:
+                    logging.getLogger('').exception('timer callback {!r} failed'.format(callback))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+from .cidr import CidrTree
+from .hostmask import HostmaskMatcher
+import heapq
+
+class ServerBans(object):
+    """Server-wide bans.  K-lines are user@host masks, checked when a client
+    registers.  D-lines are IP networks, checked as soon as a client connects.
+
+    Both are kept in the data store (the klines and dlines collections) and
+    loaded into a HostmaskMatcher and a CidrTree.  Temporary bans are removed
+    by a sweep every minute, and skipped if they're found expired before then."""
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.klines = HostmaskMatcher()
+        self.kline_entries = dict()     # casefolded mask -> entry
+        self.dlines = CidrTree()        # network -> entry
+        self.expiry = []                # heap of (expires ts, kind, key)
+
+    def load(self):
+        self.kline_store = self.ctx.data.collection('klines', 'kline.')
+        self.dline_store = self.ctx.data.collection('dlines', 'dline.')
+
+        for mask in self.kline_store:
+            self.track_kline(self.kline_store.get(mask))
+        for network in self.dline_store:
+            self.track_dline(self.dline_store.get(network))
+
+        self.ctx.logger.debug('loaded {} K-lines and {} D-lines'.format(len(self.klines), len(self.dlines)))
+        self.expire()
+
+    def expired(self, entry):
+        return entry['expires'] and entry['expires'] <= self.ctx.current_ts
+
+    def make_entry(self, key, reason, duration, setter):
+        return {
+            'mask': key,
+            'reason': reason,
+            'set_by': setter,
+            'set_ts': self.ctx.current_ts,
+            'expires': self.ctx.current_ts + duration if duration else 0,
+        }
+
+    # K-lines
+    def track_kline(self, entry):
+        self.klines.add(entry['mask'])
+        self.kline_entries[entry['mask']] = entry
+        if entry['expires']:
+            heapq.heappush(self.expiry, (entry['expires'], 'kline', entry['mask']))
+
+    def add_kline(self, mask, reason, duration=0, setter=None):
+        """Bans user@host mask for duration seconds, or for good if that's 0.
+        Returns the entry."""
+        mask = mask.casefold()
+        self.remove_kline(mask)
+        entry = self.make_entry(mask, reason, duration, setter)
+        self.kline_store.put(mask, entry)
+        self.track_kline(entry)
+        return entry
+
+    def remove_kline(self, mask):
+        mask = mask.casefold()
+        if self.kline_entries.pop(mask, None) is None:
+            return False
+        self.klines.remove(mask)
+        self.kline_store.delete(mask)
+        return True
+
+    def find_kline(self, username, *hosts):
+        """Returns the K-line entry matching username at any of hosts, or None."""
+        for host in hosts:
+            mask = self.klines.match('{}@{}'.format(username, host))
+            if mask is None:
+                continue
+            entry = self.kline_entries[mask]
+            if self.expired(entry):
+                self.remove_kline(mask)
+                return self.find_kline(username, *hosts)
+            return entry
+        return None
+
+    # D-lines
+    def track_dline(self, entry):
+        self.dlines.insert(entry['mask'], entry)
+        if entry['expires']:
+            heapq.heappush(self.expiry, (entry['expires'], 'dline', entry['mask']))
+
+    def add_dline(self, network, reason, duration=0, setter=None):
+        """Bans an IP address or network for duration seconds, or for good if that's 0.
+        Returns the entry, raises ValueError if network isn't valid."""
+        network = str(self.dlines.parse_network(network))
+        entry = self.make_entry(network, reason, duration, setter)
+        self.dline_store.put(network, entry)
+        self.track_dline(entry)
+        return entry
+
+    def remove_dline(self, network):
+        try:
+            network = str(self.dlines.parse_network(network))
+        except ValueError:
+            return False
+        if not self.dlines.remove(network):
+            return False
+        self.dline_store.delete(network)
+        return True
+
+    def find_dline(self, address):
+        """Returns the D-line entry covering address, or None."""
+        for entry in self.dlines.covering(address):
+            if not self.expired(entry):
+                return entry
+        return None
+
+    # expiry
+    def expire(self):
+        """Removes temporary bans that have run out, and re-arms itself."""
+        while self.expiry and self.expiry[0][0] <= self.ctx.current_ts:
+            expires, kind, key = heapq.heappop(self.expiry)
+            # the ban may have been removed or replaced since
+            if kind == 'kline':
+                entry = self.kline_entries.get(key, None)
+                if entry is not None and entry['expires'] == expires:
+                    self.remove_kline(key)
+            else:
+                entry = self.dlines.get(key, None)
+                if entry is not None and entry['expires'] == expires:
+                    self.remove_dline(key)
+
+        self.ctx.timers.schedule(self.expire, 60, self.ctx.clock.monotonic())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import ipaddress
+import random
+import unittest
+
+from mammon.cidr import CidrTree
+
+class CidrTreeTest(unittest.TestCase):
+    def test_covering_least_specific_first(self):
+        tree = CidrTree()
+        tree.insert('10.0.0.0/8', 'a')
+        tree.insert('10.1.0.0/16', 'b')
+        tree.insert('10.1.2.3', 'c')
+        tree.insert('10.2.0.0/16', 'd')
+        self.assertEqual(list(tree.covering('10.1.2.3')), ['a', 'b', 'c'])
+        self.assertEqual(list(tree.covering('10.1.9.9')), ['a', 'b'])
+        self.assertEqual(list(tree.covering('10.9.9.9')), ['a'])
+        self.assertEqual(list(tree.covering('11.0.0.0')), [])
+
+    def test_host_bits_are_cleared(self):
+        tree = CidrTree()
+        tree.insert('192.168.1.77/24', 'lan')
+        self.assertEqual(tree.get('192.168.1.0/24'), 'lan')
+        self.assertEqual(list(tree.covering('192.168.1.200')), ['lan'])
+
+    def test_prefix_boundaries(self):
+        tree = CidrTree()
+        tree.insert('192.168.0.0/23', 'x')
+        self.assertEqual(list(tree.covering('192.168.1.255')), ['x'])
+        self.assertEqual(list(tree.covering('192.168.2.0')), [])
+        self.assertEqual(list(tree.covering('192.167.255.255')), [])
+
+    def test_default_route(self):
+        tree = CidrTree()
+        tree.insert('0.0.0.0/0', 'all4')
+        self.assertEqual(list(tree.covering('203.0.113.1')), ['all4'])
+        self.assertEqual(list(tree.covering('2001:db8::1')), [])
+
+    def test_ipv6(self):
+        tree = CidrTree()
+        tree.insert('2001:db8::/32', 'doc')
+        tree.insert('2001:db8:1::/48', 'site')
+        tree.insert('2001:db8:1::1/128', 'host')
+        self.assertEqual(list(tree.covering('2001:db8:1::1')), ['doc', 'site', 'host'])
+        self.assertEqual(list(tree.covering('2001:db8:2::1')), ['doc'])
+        self.assertEqual(list(tree.covering('2001:db9::1')), [])
+
+    def test_ipv4_mapped_addresses(self):
+        tree = CidrTree()
+        tree.insert('198.51.100.0/24', 'v4')
+        self.assertEqual(list(tree.covering('::ffff:198.51.100.7')), ['v4'])
+
+    def test_families_are_separate(self):
+        tree = CidrTree()
+        tree.insert('::/0', 'all6')
+        self.assertEqual(list(tree.covering('10.0.0.1')), [])
+
+    def test_unparseable_address_is_covered_by_nothing(self):
+        tree = CidrTree()
+        tree.insert('0.0.0.0/0', 'all4')
+        self.assertEqual(list(tree.covering('not an address')), [])
+        self.assertEqual(list(tree.covering('')), [])
+
+    def test_invalid_network(self):
+        tree = CidrTree()
+        with self.assertRaises(ValueError):
+            tree.insert('10.0.0.0/33', 'x')
+        with self.assertRaises(ValueError):
+            tree.insert('example.com', 'x')
+
+    def test_insert_replaces(self):
+        tree = CidrTree()
+        tree.insert('10.0.0.0/8', 'a')
+        tree.insert('10.0.0.0/8', 'b')
+        self.assertEqual(len(tree), 1)
+        self.assertEqual(tree.get('10.0.0.0/8'), 'b')
+
+    def test_remove_prunes(self):
+        tree = CidrTree()
+        tree.insert('10.0.0.0/8', 'a')
+        tree.insert('10.1.2.0/24', 'b')
+        self.assertTrue(tree.remove('10.1.2.0/24'))
+        self.assertFalse(tree.remove('10.1.2.0/24'))
+        self.assertFalse(tree.remove('10.1.0.0/16'))
+        self.assertEqual(len(tree), 1)
+        self.assertEqual(list(tree.covering('10.1.2.3')), ['a'])
+
+        # the /24's path is gone, only the /8's is left
+        node = tree.roots[4]
+        depth = 0
+        while node[0] is not None or node[1] is not None:
+            node = node[0] if node[0] is not None else node[1]
+            depth += 1
+        self.assertEqual(depth, 8)
+
+        self.assertTrue(tree.remove('10.0.0.0/8'))
+        self.assertEqual(tree.roots[4], [None, None, None])
+        self.assertEqual(tree.get('10.0.0.0/8', 'gone'), 'gone')
+
+    def test_matches_linear_scan(self):
+        rng = random.Random(5)
+        tree = CidrTree()
+        networks = set()
+        for i in range(500):
+            prefix = rng.choice((8, 12, 16, 20, 24, 28, 32))
+            network = ipaddress.ip_network('{}/{}'.format(ipaddress.IPv4Address(rng.getrandbits(32) & 0xf0ffffff), prefix), strict=False)
+            networks.add(network)
+            tree.insert(str(network), network)
+
+        for i in range(1000):
+            address = ipaddress.IPv4Address(rng.getrandbits(32) & 0xf0ffffff)
+            expected = sorted((network for network in networks if address in network), key=lambda network: network.prefixlen)
+            self.assertEqual(list(tree.covering(str(address))), expected)
+
+if __name__ == '__main__':
+    unittest.main()
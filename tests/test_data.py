@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import types
+import unittest
+
+import mammon.server
+import mammon.data
+from mammon.data import DataStore, convert_snapshot, read_snapshot, write_binary_snapshot, write_json_snapshot
+
+class FakeLoop(object):
+    def call_later(self, delay, callback, *args):
+        pass
+
+# values with the awkward bits: unicode, newlines and quotes in keys and
+# strings, nesting, and every json scalar
+sample = {
+    'account.alice': {'verified': True, 'registered_ts': 1440000000, 'credentials': {'passphrase': '$6$x'}},
+    'account.bob': {'verified': False, 'registered_ts': 1440000001.5, 'callback': None},
+    'account.zoë': {'verified': True, 'tags': ['a', 'b'], 'note': 'line one\nline "two"'},
+    'weird\nkey "quoted"': [1, 2.5, None, False, {'nested': {'deeper': []}}],
+    'empty': {},
+}
+
+class StoreTestCase(unittest.TestCase):
+    """Opens data stores in a temporary directory, with a running context for them."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'mammon.data')
+        self.old_context = mammon.server.running_context
+        mammon.server.running_context = types.SimpleNamespace(
+            logger=logging.getLogger('test_data'),
+            eventloop=FakeLoop(),
+        )
+
+        self.stores = []
+
+    def tearDown(self):
+        # stop the writer threads and close the journals before the files go
+        for store in self.stores:
+            if store.format == 'sqlite':
+                store.save()
+            else:
+                store._executor.shutdown()
+                if store.format == 'journal':
+                    store._journal.close()
+        mammon.server.running_context = self.old_context
+        shutil.rmtree(self.dir)
+
+    def open(self, format, **conf):
+        conf.update({
+            'format': format,
+            'filename': self.filename,
+            'save_frequency': {'minutes': 5},
+        })
+        mammon.server.running_context.conf = types.SimpleNamespace(data=conf)
+        store = DataStore()
+        store.create_or_load()
+        self.stores.append(store)
+        return store
+
+    def contents(self, store):
+        return dict((key, store.get(key)) for key in store.list_keys())
+
+    def fill(self, store):
+        for key, value in sample.items():
+            store.put(key, value)
+
+class DataStoreTest(StoreTestCase):
+    def check_round_trip(self, format, **conf):
+        store = self.open(format, **conf)
+        self.fill(store)
+        store.save()
+        self.assertEqual(self.contents(self.open(format, **conf)), sample)
+
+        # a second snapshot only rewrites what changed
+        store = self.open(format, **conf)
+        store.put('account.bob', {'verified': True})
+        store.put('account.carol', {'verified': False})
+        store.delete('account.alice')
+        store.save()
+
+        expected = dict(sample)
+        expected['account.bob'] = {'verified': True}
+        expected['account.carol'] = {'verified': False}
+        del expected['account.alice']
+        self.assertEqual(self.contents(self.open(format, **conf)), expected)
+
+    def test_json_round_trip(self):
+        self.check_round_trip('json')
+
+    def test_binary_round_trip(self):
+        self.check_round_trip('json', snapshot_format='binary')
+
+    def test_binary_mmap_round_trip(self):
+        self.check_round_trip('json', snapshot_format='binary', mmap=True)
+
+    def test_journal_round_trip(self):
+        self.check_round_trip('journal')
+
+    def test_sqlite_round_trip(self):
+        self.check_round_trip('sqlite')
+
+    def test_snapshot_format_can_change(self):
+        store = self.open('json')
+        self.fill(store)
+        store.save()
+
+        store = self.open('json', snapshot_format='binary')
+        store.put('new', 1)
+        store.save()
+        self.assertTrue(mammon.data.is_binary_snapshot(self.filename))
+
+        store = self.open('json')
+        self.assertEqual(store.get('new'), 1)
+        store.put('newer', 2)
+        store.save()
+        self.assertFalse(mammon.data.is_binary_snapshot(self.filename))
+
+        expected = dict(sample, new=1, newer=2)
+        self.assertEqual(self.contents(self.open('json')), expected)
+
+    def test_loads_whole_file_json(self):
+        # as written before snapshots were one key per line
+        with open(self.filename, 'w') as store_file:
+            json.dump(sample, store_file)
+        self.assertEqual(self.contents(self.open('json')), sample)
+
+    def test_convert_snapshot(self):
+        source = os.path.join(self.dir, 'old.json')
+        with open(source, 'w') as store_file:
+            json.dump(sample, store_file)
+        self.assertEqual(convert_snapshot(source, self.filename), len(sample))
+        self.assertEqual(dict((key, json.loads(value)) for key, value in read_snapshot(self.filename)), sample)
+
+    def test_snapshot_writers(self):
+        items = [(key, json.dumps(value)) for key, value in sorted(sample.items())]
+
+        with open(self.filename, 'w') as store_file:
+            write_json_snapshot(store_file, items)
+        with open(self.filename) as store_file:
+            self.assertEqual(json.load(store_file), sample)
+        self.assertEqual(list(read_snapshot(self.filename)), items)
+
+        with open(self.filename, 'wb') as store_file:
+            write_binary_snapshot(store_file, items)
+        self.assertEqual(list(read_snapshot(self.filename)), items)
+        self.assertEqual(list(read_snapshot(self.filename, use_mmap=True)), items)
+
+    def test_empty_snapshot(self):
+        store = self.open('json', snapshot_format='binary')
+        store.save()
+        self.assertEqual(self.contents(self.open('json', snapshot_format='binary', mmap=True)), {})
+
+    def test_damaged_binary_snapshot(self):
+        with open(self.filename, 'wb') as store_file:
+            write_binary_snapshot(store_file, [('key', '"value"')])
+        with open(self.filename, 'r+b') as store_file:
+            store_file.seek(-2, io.SEEK_END)
+            store_file.write(b'XX')
+        with self.assertRaises(Exception):
+            list(read_snapshot(self.filename))
+
+        with open(self.filename, 'r+b') as store_file:
+            store_file.truncate(os.path.getsize(self.filename) - 4)
+        with self.assertRaises(Exception):
+            list(read_snapshot(self.filename))
+
+    def test_failed_snapshot_is_retried(self):
+        store = self.open('json')
+        self.fill(store)
+        store.save()
+
+        store = self.open('json')
+        store.put('account.bob', {'verified': True})
+
+        writer = mammon.data.write_json_snapshot
+        def failing_writer(store_file, items):
+            raise IOError('disk full')
+        mammon.data.write_json_snapshot = failing_writer
+        try:
+            with self.assertRaises(IOError):
+                store.save()
+        finally:
+            mammon.data.write_json_snapshot = writer
+
+        # the change above isn't dirty any more, but the next snapshot has it
+        store.put('account.carol', {'verified': False})
+        store.save()
+
+        expected = dict(sample)
+        expected['account.bob'] = {'verified': True}
+        expected['account.carol'] = {'verified': False}
+        self.assertEqual(self.contents(self.open('json')), expected)
+
+    def test_journal_replays_without_snapshot(self):
+        store = self.open('journal')
+        self.fill(store)
+        store.delete('empty')
+        store.delete_keys('account.')
+        store.put('account.dave', {'verified': True})
+        store.sync().result()
+
+        self.assertFalse(os.path.exists(self.filename))
+        expected = dict((key, value) for key, value in sample.items() if not key.startswith('account.') and key != 'empty')
+        expected['account.dave'] = {'verified': True}
+        self.assertEqual(self.contents(self.open('journal')), expected)
+
+    def test_journal_ignores_torn_record(self):
+        store = self.open('journal')
+        store.put('a', 1)
+        store.sync().result()
+        with open(self.filename + '.journal', 'a') as journal:
+            journal.write('["p","b",')
+
+        store = self.open('journal')
+        self.assertEqual(self.contents(store), {'a': 1})
+        store.put('c', 3)
+        store.sync().result()
+        self.assertEqual(self.contents(self.open('journal')), {'a': 1, 'c': 3})
+
+    def test_journal_rotation(self):
+        store = self.open('journal')
+        store.put('a', 1)
+        store.snapshot().result()
+        self.assertFalse(os.path.exists(self.filename + '.journal.old'))
+
+        store.put('b', 2)
+        store.sync().result()
+        self.assertEqual(self.contents(self.open('journal')), {'a': 1, 'b': 2})
+
+class CollectionTest(StoreTestCase):
+    def check_collection(self, format):
+        store = self.open(format)
+        self.fill(store)
+        accounts = store.collection('accounts', 'account.', indexes=['verified'])
+        if format == 'sqlite':
+            store.save()
+            store = self.open(format)
+            accounts = store.collection('accounts', 'account.', indexes=['verified'])
+
+        self.assertEqual(sorted(accounts), ['alice', 'bob', 'zoë'])
+        self.assertEqual(len(accounts), 3)
+        self.assertEqual(accounts.names('b'), ['bob'])
+        self.assertEqual(accounts.find('verified', True), {'alice', 'zoë'})
+        self.assertEqual(sorted(accounts.values('verified')), [False, True])
+
+        accounts.put('bob', {'verified': True})
+        accounts.delete('alice')
+        accounts.put('carol', {'verified': False})
+        self.assertEqual(accounts.find('verified', True), {'bob', 'zoë'})
+        self.assertEqual(accounts.find('verified', False), {'carol'})
+        self.assertEqual(accounts.names(), ['bob', 'carol', 'zoë'])
+        self.assertNotIn('alice', accounts)
+        self.assertIn('carol', accounts)
+
+        with self.assertRaises(Exception):
+            accounts.find('registered_ts', 1)
+        store.save()
+
+    def test_memory_collection(self):
+        self.check_collection('json')
+
+    def test_sqlite_collection(self):
+        self.check_collection('sqlite')
+
+    def test_sqlite_query_while_index_builds(self):
+        store = self.open('sqlite')
+        self.fill(store)
+        store.save()
+
+        # hold the writer before it builds the index, queries must not wait for it
+        gate = threading.Event()
+        build_index = DataStore._sqlite_build_index
+        def held_build_index(self, *args):
+            gate.wait()
+            return build_index(self, *args)
+        DataStore._sqlite_build_index = held_build_index
+        try:
+            store = self.open('sqlite')
+            accounts = store.collection('accounts', 'account.', indexes=['verified'])
+            accounts.put('bob', {'verified': True})
+            self.assertEqual(accounts.find('verified', True), {'alice', 'bob', 'zoë'})
+            self.assertEqual(accounts.values('verified'), [True])
+        finally:
+            gate.set()
+            DataStore._sqlite_build_index = build_index
+        store.save()
+
+        store = self.open('sqlite')
+        accounts = store.collection('accounts', 'account.', indexes=['verified'])
+        self.assertEqual(accounts.find('verified', True), {'alice', 'bob', 'zoë'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import random
+import unittest
+
+from mammon.framing import LineFramer
+
+def reference_frame(chunks, max_line=None):
+    """What ClientProtocol.data_received did before LineFramer."""
+    lines = []
+    recv_buffer = b''
+    for data in chunks:
+        recv_buffer += data
+        recvd = recv_buffer.replace(b'\r', b'').split(b'\n')
+        recv_buffer = recvd.pop(-1)
+        if max_line:
+            recvd = [line[:max_line] for line in recvd]
+            recv_buffer = recv_buffer[:max_line]
+        lines.extend(recvd)
+    return lines
+
+def frame_buffered(framer, chunks):
+    lines = []
+    for data in chunks:
+        while data:
+            free = framer.get_buffer()
+            nbytes = min(len(free), len(data))
+            free[:nbytes] = data[:nbytes]
+            lines.extend(framer.buffer_updated(nbytes))
+            data = data[nbytes:]
+    return lines
+
+class LineFramerTest(unittest.TestCase):
+    def test_complete_lines(self):
+        framer = LineFramer()
+        self.assertEqual(framer.feed(b'NICK a\r\nUSER a 0 * :a\r\n'), [b'NICK a', b'USER a 0 * :a'])
+
+    def test_partial_line_is_kept(self):
+        framer = LineFramer()
+        self.assertEqual(framer.feed(b'PING :x\r\nPRIV'), [b'PING :x'])
+        self.assertEqual(framer.feed(b'MSG #a :hi'), [])
+        self.assertEqual(framer.feed(b'\r\n'), [b'PRIVMSG #a :hi'])
+
+    def test_bare_newline_and_empty_lines(self):
+        framer = LineFramer()
+        self.assertEqual(framer.feed(b'a\n\r\nb\n'), [b'a', b'', b'b'])
+
+    def test_byte_at_a_time(self):
+        framer = LineFramer()
+        lines = []
+        for c in b'PING :one\r\nPING :two\r\n':
+            lines.extend(framer.feed(bytes([c])))
+        self.assertEqual(lines, [b'PING :one', b'PING :two'])
+
+    def test_truncates_complete_lines(self):
+        framer = LineFramer(max_line=8)
+        self.assertEqual(framer.feed(b'0123456789\r\nshort\r\n'), [b'01234567', b'short'])
+
+    def test_truncates_trickled_line(self):
+        framer = LineFramer(max_line=8)
+        lines = []
+        for i in range(100):
+            lines.extend(framer.feed(b'0123456789'))
+        lines.extend(framer.feed(b'\r\nnext\r\n'))
+        self.assertEqual(lines, [b'01234567', b'next'])
+
+    def test_truncates_partial_tail(self):
+        framer = LineFramer(max_line=4)
+        self.assertEqual(framer.feed(b'ok\nabcdefgh'), [b'ok'])
+        self.assertEqual(framer.feed(b'ij\n'), [b'abcd'])
+
+    def test_line_longer_than_buffer(self):
+        framer = LineFramer(size=16)
+        line = b'x' * 100
+        self.assertEqual(framer.feed(line[:50]), [])
+        self.assertEqual(framer.feed(line[50:] + b'\r\n'), [line])
+
+    def test_buffered_protocol(self):
+        framer = LineFramer(max_line=512, size=64)
+        chunks = [b'NICK a\r\n', b'USER a', b' 0 * :a\r\nJOIN #', b'x\r\n']
+        self.assertEqual(frame_buffered(framer, chunks), [b'NICK a', b'USER a 0 * :a', b'JOIN #x'])
+
+    def test_matches_reference(self):
+        rng = random.Random(7)
+        for max_line in (None, 5, 64):
+            stream = bytes(rng.choice(b'ab\r\n') for i in range(5000))
+            cuts = sorted(rng.randint(0, len(stream)) for i in range(300))
+            chunks = [stream[i:j] for i, j in zip([0] + cuts, cuts + [len(stream)])]
+
+            expected = reference_frame(chunks, max_line)
+
+            framer = LineFramer(max_line=max_line, size=16)
+            lines = []
+            for chunk in chunks:
+                lines.extend(framer.feed(chunk))
+            self.assertEqual(lines, expected)
+
+            self.assertEqual(frame_buffered(LineFramer(max_line=max_line, size=16), chunks), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import random
+import unittest
+
+from mammon.hostmask import HostmaskMatcher, mask_to_regex
+
+def glob_match(mask, s):
+    """A plain glob matcher to check against: '*' is any run, '?' any one character."""
+    mask, s = mask.casefold(), s.casefold()
+    # positions in mask reachable after consuming a prefix of s
+    states = {0}
+    def close(states):
+        states = set(states)
+        for i in sorted(states):
+            while i < len(mask) and mask[i] == '*':
+                i += 1
+                states.add(i)
+        return states
+    states = close(states)
+    for c in s:
+        following = set()
+        for i in states:
+            if i < len(mask):
+                if mask[i] == '*':
+                    following.add(i)
+                elif mask[i] == '?' or mask[i] == c:
+                    following.add(i + 1)
+        states = close(following)
+    return len(mask) in states
+
+class MaskToRegexTest(unittest.TestCase):
+    def test_escapes_everything_else(self):
+        self.assertEqual(mask_to_regex('a*b?'), 'a.*b.')
+        self.assertIn(r'\[', mask_to_regex('[x]'))
+        self.assertIn(r'\.', mask_to_regex('a.b'))
+
+class HostmaskMatcherTest(unittest.TestCase):
+    def test_literal(self):
+        matcher = HostmaskMatcher(['Nick!User@Host.Example'])
+        self.assertEqual(matcher.match('nick!user@host.example'), 'nick!user@host.example')
+        self.assertIsNone(matcher.match('nick!user@host.example.net'))
+
+    def test_host(self):
+        matcher = HostmaskMatcher(['*!*@bad.example', '*@kline.example'])
+        self.assertEqual(matcher.match('a!b@BAD.example'), '*!*@bad.example')
+        self.assertIsNone(matcher.match('a!b@notbad.example'))
+        self.assertEqual(matcher.match('user@kline.example'), '*@kline.example')
+        self.assertEqual(matcher.match('a!user@kline.example'), '*@kline.example')
+
+    def test_suffix(self):
+        matcher = HostmaskMatcher(['*!*@*.isp.example', '*@*.dsl.example'])
+        self.assertEqual(matcher.match('a!b@host1.isp.example'), '*!*@*.isp.example')
+        self.assertIsNone(matcher.match('a!b@isp.example'))
+        self.assertIsNone(matcher.match('a!b@host.isp.example.net'))
+        self.assertEqual(matcher.match('u@x.y.dsl.example'), '*@*.dsl.example')
+
+    def test_prefix(self):
+        matcher = HostmaskMatcher(['troll!*@*', 'tr?ll*!*@*.example'])
+        self.assertEqual(matcher.match('Troll!x@y'), 'troll!*@*')
+        self.assertEqual(matcher.match('trall2!x@y.example'), 'tr?ll*!*@*.example')
+        self.assertIsNone(matcher.match('trolls!x@y'))
+        self.assertIsNone(matcher.match('trall2!x@y.example.net'))
+
+    def test_others(self):
+        matcher = HostmaskMatcher(['*!~spam@*', '*bot*!*@*'])
+        self.assertEqual(matcher.match('a!~spam@b'), '*!~spam@*')
+        self.assertEqual(matcher.match('MyBot1!x@y'), '*bot*!*@*')
+        self.assertIsNone(matcher.match('a!~spammer@b'))
+
+    def test_question_mark_matches_exactly_one(self):
+        matcher = HostmaskMatcher(['*!*@10.0.0.?'])
+        self.assertIsNotNone(matcher.match('a!b@10.0.0.1'))
+        self.assertIsNone(matcher.match('a!b@10.0.0.12'))
+        self.assertIsNone(matcher.match('a!b@10.0.0.'))
+
+    def test_irc_characters_are_literal(self):
+        matcher = HostmaskMatcher(['[foo]\\|^{}!*@*', '*!*@a.b'])
+        self.assertIsNotNone(matcher.match('[foo]\\|^{}!x@y'))
+        self.assertIsNone(matcher.match('f!x@y'))
+        self.assertIsNone(matcher.match('a!b@aXb'))
+
+    def test_newline_is_not_special(self):
+        matcher = HostmaskMatcher(['*!*@host'])
+        self.assertIsNone(matcher.match('a!b@host\n'))
+
+    def test_casefold(self):
+        # casefolding, not RFC 1459 casemapping: ß folds to ss, [ and { differ
+        matcher = HostmaskMatcher(['STRASSE!*@*', '[x]!*@*'])
+        self.assertEqual(matcher.match('straße!a@b'), 'strasse!*@*')
+        self.assertIsNone(matcher.match('{x}!a@b'))
+
+    def test_add_and_remove(self):
+        masks = ['a!b@c', '*!*@host', '*!*@*.suffix', 'prefix*!*@*', '*other*!*@*']
+        matcher = HostmaskMatcher()
+        for mask in masks:
+            matcher.add(mask)
+            matcher.add(mask.upper())
+        self.assertEqual(len(matcher), len(masks))
+        self.assertIn('A!B@C', matcher)
+
+        hostmasks = ['a!b@c', 'x!y@host', 'x!y@z.suffix', 'prefix1!y@z', 'xotherx!y@z']
+        for mask, hostmask in zip(masks, hostmasks):
+            self.assertEqual(matcher.match(hostmask), mask)
+            matcher.remove(mask)
+            self.assertIsNone(matcher.match(hostmask))
+        matcher.remove('not there')
+
+        self.assertEqual(len(matcher), 0)
+        self.assertEqual(matcher.hosts, {})
+        self.assertEqual(matcher.suffixes, [set(), {}])
+        self.assertEqual(matcher.prefixes, [set(), {}])
+
+    def test_shared_trie_path_survives_removal(self):
+        matcher = HostmaskMatcher(['ab*!*@*', 'abc*!*@*'])
+        matcher.remove('abc*!*@*')
+        self.assertEqual(matcher.match('abcd!x@y'), 'ab*!*@*')
+        matcher.remove('ab*!*@*')
+        self.assertIsNone(matcher.match('abcd!x@y'))
+
+    def test_matches_plain_glob(self):
+        rng = random.Random(3)
+        alphabet = 'ab.!@'
+        def word(length):
+            return ''.join(rng.choice(alphabet) for i in range(length))
+
+        for round in range(50):
+            masks = set()
+            for i in range(20):
+                mask = list(word(rng.randint(1, 6)))
+                for j in range(rng.randint(0, 3)):
+                    mask.insert(rng.randint(0, len(mask)), rng.choice('*?'))
+                masks.add(''.join(mask))
+            masks.update(('*!*@' + word(3), '*@*.' + word(2)))
+            matcher = HostmaskMatcher(masks)
+
+            for i in range(50):
+                hostmask = word(rng.randint(0, 8))
+                found = matcher.match(hostmask)
+                expected = set(mask for mask in masks if glob_match(mask, hostmask))
+                if expected:
+                    self.assertIn(found, expected, (sorted(masks), hostmask))
+                else:
+                    self.assertIsNone(found, (sorted(masks), hostmask))
+
+if __name__ == '__main__':
+    unittest.main()
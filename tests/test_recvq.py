@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import collections
+import logging
+import types
+import unittest
+
+from mammon.recvq import RecvQScheduler, TokenBucket
+
+class TokenBucketTest(unittest.TestCase):
+    def test_starts_full(self):
+        bucket = TokenBucket(2, 5, 100.0)
+        for i in range(5):
+            self.assertTrue(bucket.ready(100.0))
+            bucket.consume(1, 100.0)
+        self.assertFalse(bucket.ready(100.0))
+
+    def test_refills_at_rate(self):
+        bucket = TokenBucket(2, 5, 100.0)
+        bucket.consume(5, 100.0)
+        self.assertFalse(bucket.ready(100.4))
+        self.assertTrue(bucket.ready(100.5))
+        self.assertEqual(bucket.tokens, 1)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(2, 5, 100.0)
+        bucket.consume(1, 100.0)
+        bucket.refill(1000.0)
+        self.assertEqual(bucket.tokens, 5)
+
+    def test_debt_must_be_paid_off(self):
+        bucket = TokenBucket(1, 5, 100.0)
+        bucket.consume(8, 100.0)
+        self.assertEqual(bucket.tokens, -3)
+        self.assertEqual(bucket.delay(100.0), 4)
+        self.assertFalse(bucket.ready(103.5))
+        self.assertTrue(bucket.ready(104.0))
+
+    def test_no_delay_with_tokens(self):
+        bucket = TokenBucket(1, 5, 100.0)
+        self.assertEqual(bucket.delay(100.0), 0)
+
+class FakeLoop(object):
+    def __init__(self):
+        self.now = 0.0
+        self.calls = []     # (when, callback, handle)
+
+    def time(self):
+        return self.now
+
+    def call_soon(self, callback):
+        return self.call_later(0, callback)
+
+    def call_later(self, delay, callback):
+        handle = types.SimpleNamespace(cancelled=False)
+        handle.cancel = lambda: setattr(handle, 'cancelled', True)
+        self.calls.append((self.now + delay, callback, handle))
+        return handle
+
+    def run_until(self, when):
+        """Runs the due callbacks in order until there are none left before when."""
+        while True:
+            due = [call for call in self.calls if not call[2].cancelled and call[0] <= when]
+            if not due:
+                break
+            call = min(due, key=lambda call: call[0])
+            self.calls.remove(call)
+            self.now = max(self.now, call[0])
+            call[1]()
+        self.now = when
+
+class FakeClient(object):
+    """The recvq side of ClientProtocol, recording the lines it handles."""
+    def __init__(self, ctx, nickname, lines, handled):
+        self.ctx = ctx
+        self.nickname = nickname
+        self.connected = True
+        self.recvq = collections.deque('{}{}'.format(nickname, i) for i in range(lines))
+        self.flood = TokenBucket(ctx.flood_rate, ctx.flood_burst, ctx.clock.monotonic())
+        self.handled = handled
+        self.fail = False
+
+    def drain_queue(self, limit=None):
+        processed = 0
+        while self.recvq and self.connected and processed < limit:
+            now = self.ctx.clock.monotonic()
+            if not self.flood.ready(now):
+                break
+            line = self.recvq.popleft()
+            self.flood.consume(1, now)
+            processed += 1
+            if self.fail:
+                raise RuntimeError(line)
+            self.handled.append(line)
+
+class RecvQSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.ctx = types.SimpleNamespace(
+            eventloop=self.loop,
+            clock=types.SimpleNamespace(monotonic=self.loop.time),
+            logger=logging.getLogger('test_recvq'),
+            flood_rate=1,
+            flood_burst=4,
+            flood_lines_per_tick=2,
+        )
+        self.ctx.recvq_scheduler = self.scheduler = RecvQScheduler(self.ctx)
+        self.handled = []
+
+    def client(self, nickname, lines):
+        cli = FakeClient(self.ctx, nickname, lines, self.handled)
+        self.scheduler.schedule(cli)
+        return cli
+
+    def test_round_robin(self):
+        self.client('a', 4)
+        self.client('b', 4)
+        self.loop.run_until(0)
+        self.assertEqual(self.handled, ['a0', 'a1', 'b0', 'b1', 'a2', 'a3', 'b2', 'b3'])
+        self.assertEqual(len(self.scheduler.ready), 0)
+
+    def test_flooder_is_rate_limited(self):
+        flooder = self.client('f', 10)
+        self.client('q', 1)
+        self.loop.run_until(0)
+        self.assertEqual(self.handled, ['f0', 'f1', 'q0', 'f2', 'f3'])
+
+        # one token a second from here on, and the scheduler wakes up for it
+        self.loop.run_until(1)
+        self.assertEqual(self.handled[-1], 'f4')
+        self.loop.run_until(6)
+        self.assertEqual(len(flooder.recvq), 0)
+        self.assertEqual(len(self.scheduler.ready), 0)
+
+    def test_disconnected_clients_are_dropped(self):
+        cli = self.client('a', 4)
+        cli.connected = False
+        self.loop.run_until(0)
+        self.assertEqual(self.handled, [])
+        self.assertNotIn(cli, self.scheduler.ready)
+
+    def test_handler_error_does_not_stall_others(self):
+        bad = self.client('bad', 4)
+        bad.fail = True
+        self.client('ok', 4)
+
+        logging.disable(logging.CRITICAL)
+        try:
+            self.loop.run_until(0)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(self.handled, ['ok0', 'ok1', 'ok2', 'ok3'])
+        self.assertEqual(len(bad.recvq), 0)
+
+    def test_earlier_wakeup_replaces_later_one(self):
+        cli = self.client('a', 10)
+        self.loop.run_until(0)
+        self.assertIsNotNone(self.scheduler.handle)
+        later = self.scheduler.handle
+
+        self.client('b', 1)
+        self.assertTrue(later.cancelled)
+        self.loop.run_until(0)
+        self.assertIn('b0', self.handled)
+
+if __name__ == '__main__':
+    unittest.main()
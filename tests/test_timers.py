@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# mammon - a useless ircd
+#
+# Copyright (c) 2015, William Pitcock <nenolod@dereferenced.org>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import logging
+import unittest
+
+from mammon.timers import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(1000.0)
+        self.fired = []
+
+    def callback(self, name):
+        def fire():
+            self.fired.append(name)
+        return fire
+
+    def test_fires_at_deadline(self):
+        self.wheel.schedule(self.callback('a'), 5, 1000.0)
+        self.wheel.advance(1004.99)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1005.0)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_never_fires_early(self):
+        self.wheel.schedule(self.callback('a'), 120, 1000.7)
+        self.wheel.advance(1120.69)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1120.99)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1121.0)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_zero_delay_runs_on_next_tick(self):
+        self.wheel.schedule(self.callback('a'), 0, 1000.0)
+        self.wheel.advance(1000.5)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1001.0)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_rearm_replaces(self):
+        fire = self.callback('a')
+        self.wheel.schedule(fire, 5, 1000.0)
+        self.wheel.schedule(fire, 10, 1003.0)
+        self.assertEqual(len(self.wheel), 1)
+        self.wheel.advance(1012.0)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1013.0)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_cancel(self):
+        fire = self.callback('a')
+        self.wheel.schedule(fire, 5, 1000.0)
+        self.wheel.cancel(fire)
+        self.wheel.cancel(fire)
+        self.wheel.advance(1010.0)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.wheel.buckets, {})
+
+    def test_advance_catches_up(self):
+        # a late tick still runs everything that became due, in order
+        for delay in (3, 1, 2):
+            self.wheel.schedule(self.callback(delay), delay, 1000.0)
+        self.wheel.advance(1010.0)
+        self.assertEqual(self.fired, [1, 2, 3])
+
+    def test_callback_can_rearm_itself(self):
+        def tick():
+            self.fired.append(self.wheel.last_tick)
+            self.wheel.schedule(tick, 1, self.wheel.last_tick)
+        self.wheel.schedule(tick, 1, 1000.0)
+        self.wheel.advance(1003.0)
+        self.assertEqual(self.fired, [1001, 1002, 1003])
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_callback_cancelling_another_in_the_same_tick(self):
+        # whichever runs first cancels the other, so only one of them fires
+        def first():
+            self.fired.append('first')
+            self.wheel.cancel(second)
+        def second():
+            self.fired.append('second')
+            self.wheel.cancel(first)
+        self.wheel.schedule(first, 1, 1000.0)
+        self.wheel.schedule(second, 1, 1000.0)
+        self.wheel.advance(1001.0)
+        self.assertEqual(len(self.fired), 1)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_failing_callback_does_not_stop_others(self):
+        def fail():
+            raise RuntimeError('timer failed')
+        self.wheel.schedule(fail, 1, 1000.0)
+        self.wheel.schedule(self.callback('a'), 1, 1000.0)
+        self.wheel.schedule(self.callback('b'), 2, 1000.0)
+
+        logging.disable(logging.CRITICAL)
+        try:
+            self.wheel.advance(1002.0)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(sorted(self.fired), ['a', 'b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_scheduled_in_the_past_goes_to_next_tick(self):
+        self.wheel.advance(1005.0)
+        self.wheel.schedule(self.callback('a'), 1, 1000.0)
+        self.wheel.advance(1005.5)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1006.0)
+        self.assertEqual(self.fired, ['a'])
+
+if __name__ == '__main__':
+    unittest.main()